@@ -1,9 +1,16 @@
-from fastapi import FastAPI, UploadFile, File, HTTPException
+from fastapi import FastAPI, UploadFile, File, HTTPException, BackgroundTasks, Request
 from fastapi.middleware.cors import CORSMiddleware
-from pydantic import BaseModel
+from fastapi.responses import StreamingResponse
+from pydantic import BaseModel, Field
+from typing import List, Optional
 from sentence_transformers import SentenceTransformer
 from qdrant_client import QdrantClient
-from qdrant_client.models import VectorParams, Distance, PointStruct
+from qdrant_client.http.exceptions import UnexpectedResponse
+from qdrant_client.models import (
+    VectorParams, Distance, PointStruct, SearchRequest, PayloadSchemaType, ScoredPoint,
+    KeywordIndexParams, KeywordIndexType, Filter, FieldCondition, MatchAny, MatchValue,
+    SetPayload, SetPayloadOperation, PointIdsList
+)
 from docx import Document
 import fitz  # PyMuPDF
 from dotenv import load_dotenv
@@ -11,7 +18,27 @@ from openpyxl import Workbook, load_workbook
 from openpyxl.utils import get_column_letter
 import openai
 from datetime import datetime
+from functools import lru_cache
+from bisect import bisect_left, bisect_right
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor, wait, FIRST_COMPLETED, TimeoutError as FuturesTimeoutError
+import tiktoken
+import numpy as np
 import pytz
+import asyncio
+import hashlib
+import threading
+try:
+    import fcntl  # POSIX
+except ImportError:
+    fcntl = None
+    import msvcrt  # Windows
+import time
+import json
+import shutil
+import re
+import sqlite3
+import uuid
 import os
 
 # === Cargar configuración de entorno y validar ===
@@ -32,16 +59,30 @@ config = cargar_config()
 
 # === Inicializar servicios ===
 openai.api_key = config["OPENAI_API_KEY"]
-model_embeddings = SentenceTransformer("sentence-transformers/all-MiniLM-L6-v2")
+MODELO_EMBEDDINGS = "sentence-transformers/all-MiniLM-L6-v2"
+model_embeddings = SentenceTransformer(MODELO_EMBEDDINGS)
+
+# Timeouts por etapa: las consultas fallan rápido; la ingesta y los snapshots admiten lotes largos
+TIMEOUT_QDRANT_S = int(os.getenv("TIMEOUT_QDRANT_S", "10"))
+TIMEOUT_QDRANT_CARGA_S = int(os.getenv("TIMEOUT_QDRANT_CARGA_S", "120"))
 
 qdrant_client = QdrantClient(
     url=config["QDRANT_URL"],
     api_key=config["QDRANT_API_KEY"],
-    timeout=120  # Aumentar timeout a 120 segundos
+    timeout=TIMEOUT_QDRANT_S
+)
+
+qdrant_client_carga = QdrantClient(
+    url=config["QDRANT_URL"],
+    api_key=config["QDRANT_API_KEY"],
+    timeout=TIMEOUT_QDRANT_CARGA_S
 )
 
 # === Constantes de la app ===
 UPLOAD_FOLDER = "docs_upload"
+SNAPSHOT_FOLDER = os.getenv("SNAPSHOT_FOLDER", "snapshots")  # Snapshots de la colección
+SNAPSHOT_BATCH_SIZE = 256  # Puntos por lote al exportar/importar snapshots
+SNAPSHOT_PARALELO = int(os.getenv("SNAPSHOT_PARALELO", "1"))  # Procesos de carga al importar
 COLLECTION_NAME = "documentos_legales_qdrant"  # Nombre más genérico
 CHUNK_SIZE = 800  # Aumentado para mejor contexto
 OVERLAP_SIZE = 200  # Superposición entre chunks para mejor coherencia
@@ -49,12 +90,90 @@ MODEL_DIM = 384
 EXCEL_PATH = "registro_chat.xlsx"
 MIN_SIMILARITY_THRESHOLD = 0.3  # Umbral mínimo de similitud
 BATCH_SIZE = 50  # Tamaño de lote para inserción en Qdrant
+SEARCH_LIMIT = 8  # Fragmentos recuperados por pregunta
+MODO_BUSQUEDA = os.getenv("MODO_BUSQUEDA", "completo")  # "completo" (payload en la búsqueda) o "ids" (retrieve posterior)
+QDRANT_PAYLOAD_EN_DISCO = os.getenv("QDRANT_PAYLOAD_EN_DISCO", "false").lower() == "true"  # Payloads en disco en vez de RAM
+CAMPOS_PAYLOAD_CONTEXTO = ["text", "chunk_index", "pagina", "articulos", "documento_tipo", "documento_especialidad"]  # Campos necesarios para armar el contexto
+INDICES_PAYLOAD = {
+    "documento_tipo": PayloadSchemaType.KEYWORD,
+    "documento_especialidad": KeywordIndexParams(type=KeywordIndexType.KEYWORD, is_tenant=True),  # Un shard por especialidad
+    "chunk_index": PayloadSchemaType.INTEGER,
+    "pagina": PayloadSchemaType.INTEGER,
+    "articulos": PayloadSchemaType.KEYWORD
+}
+UMBRAL_CONFIANZA_RUTEO = int(os.getenv("UMBRAL_CONFIANZA_RUTEO", "2"))  # Keywords mínimos para buscar solo en una especialidad
+MAX_PREGUNTAS_LOTE = 500  # Máximo de preguntas por llamada a /chat/lote
+MAX_GENERACIONES_CONCURRENTES = int(os.getenv("MAX_GENERACIONES_CONCURRENTES", "8"))  # Llamadas simultáneas a OpenAI en lotes
+
+# Límites de OpenAI por modelo: (peticiones por minuto, tokens por minuto)
+LIMITES_OPENAI = {
+    "gpt-3.5-turbo": (3500, 200000),
+    "gpt-3.5-turbo-16k": (3500, 200000),
+    "gpt-4": (500, 10000),
+    "gpt-4-turbo-preview": (500, 30000),
+    "gpt-4o": (500, 30000),
+    "gpt-4o-mini": (500, 200000)
+}
+LIMITES_OPENAI_DEFAULT = (500, 30000)
+OPENAI_RPM = int(os.getenv("OPENAI_RPM", "0"))  # 0 = usar tabla por modelo
+OPENAI_TPM = int(os.getenv("OPENAI_TPM", "0"))  # 0 = usar tabla por modelo
+OPENAI_MAX_REINTENTOS = 3  # Reintentos ante RateLimitError antes de devolver error
+
+OPENAI_BASE_URL = os.getenv("OPENAI_BASE_URL")  # Opcional: proxy o servidor simulado compatible con OpenAI
+OPENAI_MODELO_RESPALDO = os.getenv("OPENAI_MODELO_RESPALDO", "gpt-4o-mini")  # Modelo rápido para hedging ("" = desactivado)
+HEDGE_UMBRAL_S = float(os.getenv("HEDGE_UMBRAL_S", "10"))  # Segundos sin respuesta antes de lanzar el respaldo
+DEADLINE_RESPUESTA_S = float(os.getenv("DEADLINE_RESPUESTA_S", "60"))  # Plazo máximo por sentencia
+DEADLINE_MAXIMO_S = float(os.getenv("DEADLINE_MAXIMO_S", "300"))  # Mayor plazo que puede pedir un cliente
+HEDGE_MAX_HILOS = 32  # Hilos para llamadas en paralelo principal/respaldo
+INTERVALO_CANCELACION_S = 0.25  # Cada cuánto se comprueba si el cliente sigue conectado
+
+SYSTEM_PROMPT_JUEZ = "Eres un juez especializado en derecho ecuatoriano. Siempre debes responder con el formato estructurado de una sentencia judicial, incluyendo fecha, razón, veredicto, lugar de reclusión y conclusión. Sé preciso en las citas legales y mantén la imparcialidad judicial."
 OPENAI_MODEL = os.getenv("OPENAI_MODEL", "gpt-3.5-turbo")  # Modelo configurable
 
+# Presupuesto de tokens para el contexto legal según el modelo (deja espacio al prompt y a la respuesta)
+CONTEXT_TOKEN_BUDGETS = {
+    "gpt-3.5-turbo": 3000,
+    "gpt-3.5-turbo-16k": 8000,
+    "gpt-4": 3500,
+    "gpt-4-turbo-preview": 8000,
+    "gpt-4o": 8000,
+    "gpt-4o-mini": 8000
+}
+CONTEXT_TOKEN_BUDGET_DEFAULT = int(os.getenv("CONTEXT_TOKEN_BUDGET", "0"))  # 0 = usar tabla por modelo
+PATRONES_PATH = os.getenv("PATRONES_PATH", "patrones_documentos.json")  # Registro de tipos de documento
+UMBRAL_CONFIANZA_ALTA = 3  # Keywords distintos para confianza alta
+MARGEN_PARADA_TEMPRANA = 2  # Ventaja sobre el segundo tipo para detener la clasificación
+TAM_BLOQUE_CLASIFICACION = 64 * 1024  # Caracteres por bloque al clasificar
+REGEX_ARTICULO = re.compile(r"(?:^|\n)[ \t]*Art(?:[íi]culo|\.)[ \t]*(\d+)[ \t]*\.?[ \t]*-", re.IGNORECASE)  # Encabezados "Art. 140.-"
+# Citas en preguntas: "art. 140", "arts 196 y 197", "artículos 140, 141 y 142 del COIP". Tras una coma o "y/e"
+# solo sigue la lista si el número va seguido de fin de cita o del nombre de un código ("140 y 5 personas"
+# cita solo el 140). {codigos} se completa con los nombres del registro de patrones al cargarlo
+REGEX_CITA_ARTICULO = (
+    r"\bart(?:[íi]culos?|s?\.?)\s*(\d+\b(?:\s*(?:,|y|e)\s*(?:art(?:[íi]culos?|s?\.?)\s*)?\d+\b"
+    r"(?=\s*(?:$|[,.;:)?!]|y\s|e\s|del?\b|numeral|inciso|literal{codigos})))*)"
+)
+MAX_CHUNKS_POR_ARTICULO = 8  # Chunks máximos por artículo citado (el presupuesto de tokens recorta después)
+ANCHO_HISTOGRAMA = 100  # Caracteres por intervalo del histograma de longitudes
+ESTADO_DB_PATH = os.getenv("ESTADO_DB_PATH", "estado_app.db")  # Estado compartido entre workers
+SESIONES_DB_PATH = os.getenv("SESIONES_DB_PATH", "sesiones.db")  # Historial de conversaciones
+CUPOS_DB_PATH = os.getenv("CUPOS_DB_PATH", "cupos_openai.db")  # Cubetas de límites de OpenAI compartidas entre workers
+SESION_TTL_S = int(os.getenv("SESION_TTL_S", "3600"))  # Inactividad máxima de una sesión
+MAX_SESIONES = int(os.getenv("MAX_SESIONES", "1000"))  # Sesiones guardadas como máximo
+SESION_TURNOS_RECIENTES = 2  # Turnos que se conservan literalmente; los anteriores van al resumen
+SESION_RESUMEN_MAX_TOKENS = 300  # Tamaño máximo del resumen acumulado
+SESION_MAX_CARACTERES_RESPUESTA = 600  # Caracteres guardados por pregunta/veredicto de cada turno
+MODELO_RESUMEN = os.getenv("MODELO_RESUMEN", "gpt-4o-mini")  # Modelo para el resumen de sesiones
+CIRCUITO_UMBRAL_FALLOS = int(os.getenv("CIRCUITO_UMBRAL_FALLOS", "5"))  # Fallos seguidos que abren el circuito
+CIRCUITO_APERTURA_S = float(os.getenv("CIRCUITO_APERTURA_S", "30"))  # Tiempo abierto antes de probar de nuevo
+CACHE_SEMANTICO_MAX = 500  # Respuestas recientes guardadas para responder con OpenAI caído
+CACHE_SEMANTICO_UMBRAL = 0.92  # Similitud mínima entre preguntas para reutilizar una respuesta
+CAMPOS_CACHE_SEMANTICO = ["respuesta", "fuente", "modelo_usado", "documento_tipo", "documento_especialidad"]  # Lo único que se reutiliza
+
 os.makedirs(UPLOAD_FOLDER, exist_ok=True)
+os.makedirs(SNAPSHOT_FOLDER, exist_ok=True)
 
-# Variable global para almacenar información del documento actual
-documento_actual = {
+# Información del documento actual (valores por defecto si no hay documento cargado)
+DOCUMENTO_VACIO = {
     "tipo": None,
     "especialidad": None,
     "descripcion": None,
@@ -62,6 +181,388 @@ documento_actual = {
     "fecha_carga": None
 }
 
+# === Estado compartido entre workers ===
+# El documento actual y el modelo configurado se guardan en SQLite para que todos los
+# workers de un mismo host respondan igual (WAL no sirve entre hosts ni en disco de red); cada hilo mantiene una caché que solo se recarga
+# cuando PRAGMA data_version indica que otra conexión escribió
+estado_local = threading.local()
+
+def _conexion_estado() -> sqlite3.Connection:
+    conexion = getattr(estado_local, "conexion", None)
+    if conexion is None:
+        conexion = sqlite3.connect(ESTADO_DB_PATH, timeout=5)
+        conexion.execute("PRAGMA journal_mode=WAL")
+        conexion.execute("CREATE TABLE IF NOT EXISTS estado (clave TEXT PRIMARY KEY, valor TEXT NOT NULL, actualizado TEXT NOT NULL)")
+        conexion.commit()
+        estado_local.conexion = conexion
+        estado_local.version = None
+        estado_local.cache = {}
+    return conexion
+
+def leer_estado(clave: str, default=None):
+    conexion = _conexion_estado()
+    version = conexion.execute("PRAGMA data_version").fetchone()[0]
+    if version != estado_local.version:
+        filas = conexion.execute("SELECT clave, valor FROM estado").fetchall()
+        estado_local.cache = {k: json.loads(v) for k, v in filas}
+        estado_local.version = version
+    return estado_local.cache.get(clave, default)
+
+def guardar_estado(clave: str, valor):
+    conexion = _conexion_estado()
+    with conexion:
+        conexion.execute(
+            "INSERT OR REPLACE INTO estado (clave, valor, actualizado) VALUES (?, ?, ?)",
+            (clave, json.dumps(valor, ensure_ascii=False), datetime.now().isoformat())
+        )
+    # Las escrituras propias no cambian data_version: actualizar la caché directamente
+    estado_local.cache[clave] = valor
+
+def listar_estado(prefijo: str) -> dict:
+    leer_estado(prefijo)  # Refrescar la caché si otro proceso escribió
+    return {clave: valor for clave, valor in estado_local.cache.items() if clave.startswith(prefijo)}
+
+def incrementar_estado(clave: str, cantidad: int, inicial: int = 0) -> int:
+    """
+    Suma cantidad a un contador en una sola transacción (atómico entre workers) y devuelve el valor anterior
+    """
+    conexion = _conexion_estado()
+    ahora = datetime.now().isoformat()
+    conexion.execute("BEGIN IMMEDIATE")
+    try:
+        conexion.execute(
+            "INSERT OR IGNORE INTO estado (clave, valor, actualizado) VALUES (?, ?, ?)",
+            (clave, json.dumps(inicial), ahora)
+        )
+        nuevo = conexion.execute(
+            "UPDATE estado SET valor = CAST(valor AS INTEGER) + ?, actualizado = ? WHERE clave = ? RETURNING CAST(valor AS INTEGER)",
+            (cantidad, ahora, clave)
+        ).fetchone()[0]
+        conexion.commit()
+    except Exception:
+        conexion.rollback()
+        raise
+    estado_local.cache[clave] = nuevo
+    return nuevo - cantidad
+
+def borrar_estado(clave: str):
+    conexion = _conexion_estado()
+    with conexion:
+        conexion.execute("DELETE FROM estado WHERE clave = ?", (clave,))
+    estado_local.cache.pop(clave, None)
+
+# === Sesiones de conversación ===
+# Historial por sesión en SQLite aparte (no invalida la caché del estado en cada turno),
+# con expiración por TTL y un máximo de sesiones. Cada sesión guarda un resumen acumulado
+# y los últimos turnos, de modo que el prompt no crece con la conversación.
+def _conexion_sesiones() -> sqlite3.Connection:
+    conexion = getattr(estado_local, "conexion_sesiones", None)
+    if conexion is None:
+        conexion = sqlite3.connect(SESIONES_DB_PATH, timeout=5)
+        conexion.execute("PRAGMA journal_mode=WAL")
+        conexion.execute("CREATE TABLE IF NOT EXISTS sesiones (id TEXT PRIMARY KEY, datos TEXT NOT NULL, actualizado REAL NOT NULL)")
+        conexion.execute("CREATE INDEX IF NOT EXISTS idx_sesiones_actualizado ON sesiones (actualizado)")
+        conexion.commit()
+        estado_local.conexion_sesiones = conexion
+    return conexion
+
+def leer_sesion(sesion_id: str):
+    fila = _conexion_sesiones().execute("SELECT datos, actualizado FROM sesiones WHERE id = ?", (sesion_id,)).fetchone()
+    if not fila or time.time() - fila[1] > SESION_TTL_S:
+        return None
+    return json.loads(fila[0])
+
+def _escribir_sesion(conexion: sqlite3.Connection, sesion_id: str, datos: dict):
+    ahora = time.time()
+    conexion.execute(
+        "INSERT OR REPLACE INTO sesiones (id, datos, actualizado) VALUES (?, ?, ?)",
+        (sesion_id, json.dumps(datos, ensure_ascii=False), ahora)
+    )
+    # Expulsar sesiones vencidas y las más antiguas por encima del máximo
+    conexion.execute("DELETE FROM sesiones WHERE actualizado < ?", (ahora - SESION_TTL_S,))
+    conexion.execute(
+        "DELETE FROM sesiones WHERE id NOT IN (SELECT id FROM sesiones ORDER BY actualizado DESC LIMIT ?)",
+        (MAX_SESIONES,)
+    )
+
+def guardar_sesion(sesion_id: str, datos: dict):
+    conexion = _conexion_sesiones()
+    with conexion:
+        _escribir_sesion(conexion, sesion_id, datos)
+
+def modificar_sesion(sesion_id: str, cambio):
+    """
+    Lectura-modificación-escritura de una sesión en una sola transacción (atómico entre hilos y workers).
+    cambio(sesion) modifica el dict en sitio; si devuelve False no se escribe nada.
+    """
+    conexion = _conexion_sesiones()
+    conexion.execute("BEGIN IMMEDIATE")
+    try:
+        fila = conexion.execute("SELECT datos, actualizado FROM sesiones WHERE id = ?", (sesion_id,)).fetchone()
+        sesion = None
+        if fila and time.time() - fila[1] <= SESION_TTL_S:
+            sesion = json.loads(fila[0])
+            if cambio(sesion) is False:
+                sesion = None
+            else:
+                _escribir_sesion(conexion, sesion_id, sesion)
+        conexion.commit()
+    except Exception:
+        conexion.rollback()
+        raise
+    return sesion
+
+def borrar_sesion(sesion_id: str):
+    conexion = _conexion_sesiones()
+    with conexion:
+        conexion.execute("DELETE FROM sesiones WHERE id = ?", (sesion_id,))
+
+def crear_sesion() -> str:
+    sesion_id = uuid.uuid4().hex
+    guardar_sesion(sesion_id, {"resumen": "", "turnos": [], "total_turnos": 0, "creada": datetime.now().isoformat()})
+    return sesion_id
+
+def historial_sesion(sesion: dict) -> str:
+    """
+    Texto de antecedentes para el prompt: resumen acumulado + últimos turnos
+    """
+    partes = []
+    if sesion.get("resumen"):
+        partes.append(f"Resumen: {sesion['resumen']}")
+    for turno in sesion.get("turnos", []):
+        partes.append(f"Consulta previa: {turno['pregunta']}\nDecisión previa: {turno['respuesta']}")
+    return "\n".join(partes)
+
+def extraer_veredicto(respuesta: str) -> str:
+    # De la sentencia solo se conserva el veredicto, que es lo que necesitan los turnos siguientes
+    inicio = respuesta.find("🏛️ **VEREDICTO:**")
+    if inicio >= 0:
+        fin = respuesta.find("🏢", inicio)
+        respuesta = respuesta[inicio + len("🏛️ **VEREDICTO:**"):fin if fin > 0 else None]
+    return " ".join(respuesta.split())[:SESION_MAX_CARACTERES_RESPUESTA]
+
+def resumir_turno(resumen: str, turno: dict) -> str:
+    """
+    Incorpora un turno antiguo al resumen acumulado, con tamaño máximo fijo
+    """
+    nuevo_texto = f"{resumen}\nConsulta: {turno['pregunta']}\nDecisión: {turno['respuesta']}".strip()
+    prompt = f"""Actualiza el resumen de una conversación sobre un caso legal.
+
+RESUMEN ACTUAL:
+{resumen or "(vacío)"}
+
+NUEVO TURNO:
+Consulta: {turno['pregunta']}
+Decisión: {turno['respuesta']}
+
+Devuelve solo el resumen actualizado, en español, con los hechos del caso, las personas involucradas, los artículos citados y las decisiones tomadas. Máximo {SESION_RESUMEN_MAX_TOKENS} tokens."""
+    try:
+        resumen_nuevo = llamar_openai(
+            prompt,
+            MODELO_RESUMEN,
+            max_tokens=SESION_RESUMEN_MAX_TOKENS,
+            system_prompt="Eres un asistente que resume conversaciones legales de forma fiel y concisa."
+        )
+    except Exception as e:
+        # Sin OpenAI: resumen extractivo, conservando lo más reciente
+        print(f"Error al resumir sesión, se usa resumen extractivo: {str(e)}")
+        resumen_nuevo = nuevo_texto
+    return recortar_a_tokens_final(resumen_nuevo, SESION_RESUMEN_MAX_TOKENS, MODELO_RESUMEN)
+
+def agregar_turno(sesion_id: str, pregunta: str, respuesta: str):
+    """
+    Añade el turno a la sesión antes de responder, para que la siguiente pregunta ya lo vea.
+    Devuelve la sesión actualizada (None si expiró).
+    """
+    turno = {"pregunta": pregunta[:SESION_MAX_CARACTERES_RESPUESTA], "respuesta": extraer_veredicto(respuesta)}
+
+    def agregar(sesion):
+        sesion["turnos"].append(turno)
+        sesion["total_turnos"] = sesion.get("total_turnos", 0) + 1
+
+    return modificar_sesion(sesion_id, agregar)
+
+def plegar_sesion(sesion_id: str):
+    """
+    Pliega los turnos antiguos en el resumen (en segundo plano: llama a OpenAI).
+    El resumen se calcula fuera de la transacción y solo se guarda si la sesión no cambió
+    en esas partes mientras tanto; los turnos añadidos entre medias se conservan.
+    """
+    sesion = leer_sesion(sesion_id)
+    if sesion is None or len(sesion["turnos"]) <= SESION_TURNOS_RECIENTES:
+        return
+    resumen_base = sesion["resumen"]
+    plegados = sesion["turnos"][:len(sesion["turnos"]) - SESION_TURNOS_RECIENTES]
+    resumen = resumen_base
+    for turno in plegados:
+        resumen = resumir_turno(resumen, turno)
+
+    def aplicar(actual):
+        # Compare-and-swap: otro plegado ya consumió estos turnos
+        if actual["resumen"] != resumen_base or actual["turnos"][:len(plegados)] != plegados:
+            return False
+        actual["resumen"] = resumen
+        actual["turnos"] = actual["turnos"][len(plegados):]
+
+    if modificar_sesion(sesion_id, aplicar) is None:
+        print(f"Plegado de la sesión {sesion_id} descartado: la sesión cambió o expiró")
+
+def leer_documento_actual() -> dict:
+    return {**DOCUMENTO_VACIO, **leer_estado("documento_actual", {})}
+
+def leer_modelo_actual() -> str:
+    return leer_estado("openai_model", OPENAI_MODEL)
+
+# === Circuit breakers de Qdrant y OpenAI ===
+# Tras CIRCUITO_UMBRAL_FALLOS fallos seguidos el circuito se abre y las llamadas fallan al
+# instante; pasado CIRCUITO_APERTURA_S se deja pasar una sola llamada de prueba (semiabierto)
+# que lo cierra si tiene éxito o lo vuelve a abrir si falla. El estado es por proceso.
+class CircuitoAbierto(Exception):
+    """La dependencia está marcada como caída: no se intenta la llamada"""
+
+class CircuitBreaker:
+    def __init__(self, nombre: str, umbral_fallos: int = CIRCUITO_UMBRAL_FALLOS, apertura_s: float = CIRCUITO_APERTURA_S):
+        self.nombre = nombre
+        self.umbral_fallos = umbral_fallos
+        self.apertura_s = apertura_s
+        self.lock = threading.Lock()
+        self.estado_actual = "cerrado"
+        self.fallos_seguidos = 0
+        self.abierto_desde = 0.0
+        self.sonda_en_curso = False
+        self.ultimo_error = None
+        self.metricas = {"llamadas": 0, "fallos": 0, "rechazadas": 0, "aperturas": 0, "sondas": 0}
+
+    def abierto(self) -> bool:
+        # Abierto y aún sin llegar el momento de la sonda: no vale la pena intentar
+        with self.lock:
+            if self.estado_actual == "abierto":
+                return time.monotonic() - self.abierto_desde < self.apertura_s
+            return self.estado_actual == "semiabierto" and self.sonda_en_curso
+
+    def permitir(self):
+        with self.lock:
+            if self.estado_actual == "abierto" and time.monotonic() - self.abierto_desde >= self.apertura_s:
+                self.estado_actual = "semiabierto"
+            if self.estado_actual == "cerrado":
+                self.metricas["llamadas"] += 1
+                return
+            if self.estado_actual == "semiabierto" and not self.sonda_en_curso:
+                self.sonda_en_curso = True
+                self.metricas["llamadas"] += 1
+                self.metricas["sondas"] += 1
+                print(f"Circuito {self.nombre}: semiabierto, enviando llamada de prueba")
+                return
+        raise self.rechazar()
+
+    def rechazar(self) -> CircuitoAbierto:
+        # Cuenta una llamada no intentada y devuelve la excepción para lanzarla
+        with self.lock:
+            self.metricas["rechazadas"] += 1
+            restante = max(0.0, self.apertura_s - (time.monotonic() - self.abierto_desde))
+        return CircuitoAbierto(f"{self.nombre} no disponible (circuito abierto, nuevo intento en {restante:.0f} s)")
+
+    def registrar_exito(self):
+        with self.lock:
+            if self.estado_actual != "cerrado":
+                print(f"Circuito {self.nombre}: cerrado, el servicio respondió")
+            self.estado_actual = "cerrado"
+            self.fallos_seguidos = 0
+            self.sonda_en_curso = False
+
+    def registrar_fallo(self, error: Exception):
+        with self.lock:
+            self.metricas["fallos"] += 1
+            self.fallos_seguidos += 1
+            self.ultimo_error = str(error)[:200]
+            if self.estado_actual == "semiabierto" or self.fallos_seguidos >= self.umbral_fallos:
+                if self.estado_actual != "abierto":
+                    self.metricas["aperturas"] += 1
+                    print(f"Circuito {self.nombre}: abierto tras {self.fallos_seguidos} fallos seguidos ({self.ultimo_error})")
+                self.estado_actual = "abierto"
+                self.abierto_desde = time.monotonic()
+            self.sonda_en_curso = False
+
+    def liberar(self):
+        # La llamada terminó sin dar información sobre el servicio (p. ej. error del cliente)
+        with self.lock:
+            self.sonda_en_curso = False
+
+    def ejecutar(self, funcion, *args, es_fallo=lambda e: True, **kwargs):
+        self.permitir()
+        try:
+            resultado = funcion(*args, **kwargs)
+        except Exception as e:
+            if es_fallo(e):
+                self.registrar_fallo(e)
+            else:
+                self.liberar()
+            raise
+        self.registrar_exito()
+        return resultado
+
+    def estado(self) -> dict:
+        with self.lock:
+            return {
+                "estado": self.estado_actual,
+                "fallos_seguidos": self.fallos_seguidos,
+                "umbral_fallos": self.umbral_fallos,
+                "reintento_en_s": round(max(0.0, self.apertura_s - (time.monotonic() - self.abierto_desde)), 1) if self.estado_actual == "abierto" else None,
+                "ultimo_error": self.ultimo_error,
+                **self.metricas
+            }
+
+def es_fallo_qdrant(e: Exception) -> bool:
+    # Las respuestas 4xx (colección inexistente, petición inválida) no indican una caída
+    if isinstance(e, UnexpectedResponse):
+        return e.status_code is None or e.status_code >= 500
+    return not isinstance(e, ValueError)
+
+def es_fallo_openai(e: Exception) -> bool:
+    # Conexión, timeout y 5xx; los rate limits los gestiona el gobernador
+    return isinstance(e, (openai.APIConnectionError, openai.InternalServerError))
+
+circuito_qdrant = CircuitBreaker("qdrant")
+circuito_openai = CircuitBreaker("openai")
+
+def consultar_qdrant(funcion, *args, **kwargs):
+    """
+    Ejecuta una llamada a Qdrant a través de su circuit breaker
+    """
+    return circuito_qdrant.ejecutar(funcion, *args, es_fallo=es_fallo_qdrant, **kwargs)
+
+# === Caché semántica de respuestas ===
+# Últimas respuestas generadas con el vector de su pregunta; solo se usan para degradar
+# cuando el circuito de OpenAI está abierto (el modelo de embeddings es local). Se guarda una
+# copia con solo los campos de la respuesta: nada de la sesión ni de la petición original
+cache_semantico = deque(maxlen=CACHE_SEMANTICO_MAX)
+lock_cache_semantico = threading.Lock()
+
+def guardar_en_cache_semantico(vector, pregunta: str, respuesta: dict):
+    if vector is None:
+        return
+    vector = np.asarray(vector, dtype=np.float32)
+    copia = {campo: respuesta[campo] for campo in CAMPOS_CACHE_SEMANTICO if campo in respuesta}
+    with lock_cache_semantico:
+        cache_semantico.append((vector / (np.linalg.norm(vector) or 1.0), pregunta, copia))
+
+def buscar_en_cache_semantico(vector):
+    """
+    Devuelve (pregunta, respuesta, similitud) de la entrada más parecida, o None
+    """
+    if vector is None:
+        return None
+    with lock_cache_semantico:
+        entradas = list(cache_semantico)
+    if not entradas:
+        return None
+    vector = np.asarray(vector, dtype=np.float32)
+    similitudes = np.stack([entrada[0] for entrada in entradas]) @ (vector / (np.linalg.norm(vector) or 1.0))
+    mejor = int(np.argmax(similitudes))
+    if similitudes[mejor] < CACHE_SEMANTICO_UMBRAL:
+        return None
+    return entradas[mejor][1], entradas[mejor][2], float(similitudes[mejor])
+
 # === FastAPI App ===
 app = FastAPI(title="Chatbot Leyes")
 
@@ -75,18 +576,157 @@ app.add_middleware(
 
 # === Utilidades ===
 def inicializar_qdrant():
-    qdrant_client.recreate_collection(
+    qdrant_client_carga.recreate_collection(
+        collection_name=COLLECTION_NAME,
+        vectors_config=VectorParams(size=MODEL_DIM, distance=Distance.COSINE),
+        on_disk_payload=QDRANT_PAYLOAD_EN_DISCO
+    )
+    crear_indices_payload()
+
+def asegurar_coleccion():
+    """
+    Crea la colección si no existe; los documentos ya cargados de otras especialidades se conservan.
+    Los índices de payload se crean siempre (idempotente) para que colecciones antiguas reciban el índice tenant.
+    """
+    collection_names = [collection.name for collection in qdrant_client_carga.get_collections().collections]
+    if COLLECTION_NAME not in collection_names:
+        inicializar_qdrant()
+    else:
+        crear_indices_payload()
+
+def reservar_ids(cantidad: int) -> int:
+    """
+    Reserva un rango de IDs de punto para un documento nuevo y devuelve el primero
+    """
+    inicial = 0
+    if leer_estado("siguiente_id_punto") is None:
+        # Colecciones anteriores a la carga de varios documentos: IDs 0..N-1
+        inicial = qdrant_client_carga.count(collection_name=COLLECTION_NAME, exact=True).count
+    return incrementar_estado("siguiente_id_punto", cantidad, inicial)
+
+def eliminar_documento_tipo(tipo: str):
+    """
+    Elimina los puntos, estadísticas y entradas del índice de artículos de un tipo de documento
+    (al volver a cargar un código se reemplaza su versión anterior)
+    """
+    qdrant_client_carga.delete(
+        collection_name=COLLECTION_NAME,
+        points_selector=Filter(must=[FieldCondition(key="documento_tipo", match=MatchValue(value=tipo))]),
+        wait=True
+    )
+    borrar_estadisticas_tipo(tipo)
+    indice = leer_estado("indice_articulos", {})
+    if tipo in indice:
+        del indice[tipo]
+        guardar_estado("indice_articulos", indice)
+
+def borrar_estadisticas_tipo(tipo: str):
+    # Las estadísticas sin tipo son de cuando la colección tenía un solo documento (el actual):
+    # se completan antes de comparar, y antes de que cambie el documento actual
+    documento_actual = leer_documento_actual()
+    for clave, stats in listar_estado("estadisticas_documento:").items():
+        if "tipo" not in stats:
+            stats.update(tipo=documento_actual["tipo"], especialidad=documento_actual["especialidad"])
+            guardar_estado(clave, stats)
+        if stats["tipo"] == tipo:
+            borrar_estado(clave)
+
+def registrar_documento_cargado(filename: str, tipo_documento: dict, chunks, vectores, metadatos, ids, paginas_con_texto: int = None):
+    """
+    Guarda el documento actual, sus estadísticas y su índice de artículos tras cargarlo en Qdrant
+    """
+    guardar_estado("documento_actual", {
+        "tipo": tipo_documento.get("tipo"),
+        "especialidad": tipo_documento.get("especialidad"),
+        "descripcion": tipo_documento.get("descripcion"),
+        "filename": filename,
+        "fecha_carga": datetime.now().isoformat()
+    })
+
+    # Estadísticas exactas del corpus calculadas una sola vez en la ingesta
+    estadisticas = calcular_estadisticas_documento(chunks, vectores, metadatos, paginas_con_texto)
+    estadisticas["tipo"] = tipo_documento.get("tipo")
+    estadisticas["especialidad"] = tipo_documento.get("especialidad")
+    registrar_estadisticas_documento(filename, estadisticas)
+
+    # Índice directo (documento, artículo) -> IDs de punto
+    registrar_indice_articulos(construir_indice_articulos(tipo_documento.get("tipo"), metadatos, ids), reemplazar=False)
+
+def crear_indices_payload(collection_name: str = COLLECTION_NAME):
+    """
+    Crea índices sobre los campos filtrables del payload para acelerar búsquedas con filtro
+    """
+    for campo, tipo in INDICES_PAYLOAD.items():
+        qdrant_client_carga.create_payload_index(
+            collection_name=collection_name,
+            field_name=campo,
+            field_schema=tipo
+        )
+
+def completar_payloads(resultados, campos=None):
+    """
+    Recupera en una sola llamada el payload de los resultados buscados solo por ID y score
+    """
+    faltantes = list(dict.fromkeys(r.id for r in resultados if r.payload is None))
+    if faltantes:
+        registros = consultar_qdrant(
+            qdrant_client.retrieve,
+            collection_name=COLLECTION_NAME,
+            ids=faltantes,
+            with_payload=campos or CAMPOS_PAYLOAD_CONTEXTO,
+            with_vectors=False
+        )
+        payloads = {registro.id: registro.payload for registro in registros}
+        for resultado in resultados:
+            if resultado.payload is None:
+                resultado.payload = payloads.get(resultado.id, {})
+    return resultados
+
+def filtro_especialidades(especialidades):
+    if not especialidades:
+        return None
+    return Filter(must=[FieldCondition(key="documento_especialidad", match=MatchAny(any=list(especialidades)))])
+
+def buscar_contexto(vector, limit: int = SEARCH_LIMIT, modo: str = None, especialidades=None):
+    """
+    Busca los fragmentos más similares. En modo "ids" la búsqueda devuelve solo IDs y scores
+    y el texto se recupera después en un único retrieve del top final.
+    Con especialidades la búsqueda se limita a sus shards.
+    """
+    modo = modo or MODO_BUSQUEDA
+    resultados = consultar_qdrant(
+        qdrant_client.search,
         collection_name=COLLECTION_NAME,
-        vectors_config=VectorParams(size=MODEL_DIM, distance=Distance.COSINE)
+        query_vector=vector,
+        query_filter=filtro_especialidades(especialidades),
+        limit=limit,
+        score_threshold=MIN_SIMILARITY_THRESHOLD,
+        with_payload=False if modo == "ids" else CAMPOS_PAYLOAD_CONTEXTO
     )
+    if modo == "ids":
+        completar_payloads(resultados)
+    return resultados
 
 # extrae texto de pdf y lo divide en fragmentos con superposición
 def pdf_a_chunks(file_path: str, chunk_size: int = CHUNK_SIZE, overlap_size: int = OVERLAP_SIZE):
+    chunks, tipo_doc, metadatos, paginas_con_texto = extraer_chunks_pdf(file_path, chunk_size, overlap_size)
+    vectores = model_embeddings.encode(chunks)
+    return chunks, vectores, tipo_doc, metadatos, paginas_con_texto
+
+def extraer_chunks_pdf(file_path: str, chunk_size: int = CHUNK_SIZE, overlap_size: int = OVERLAP_SIZE):
+    """
+    Extrae el texto del PDF y lo divide en chunks con sus metadatos, sin calcular embeddings.
+    Devuelve también cuántas páginas tienen texto (incluidas las cortas donde no empieza ningún chunk).
+    """
     texto = ""
+    inicios_pagina = []  # Offset donde empieza cada página dentro del texto
+    numeros_pagina = []
     with fitz.open(file_path) as doc:
-        for page in doc:
+        for numero, page in enumerate(doc, start=1):
             page_text = page.get_text()
             if page_text.strip():  # Solo agregar páginas con contenido
+                inicios_pagina.append(len(texto))
+                numeros_pagina.append(numero)
                 texto += page_text.strip() + "\n\n"
 
     texto = texto.strip()
@@ -97,8 +737,13 @@ def pdf_a_chunks(file_path: str, chunk_size: int = CHUNK_SIZE, overlap_size: int
     filename = os.path.basename(file_path)
     tipo_doc = detectar_tipo_documento(texto, filename)
     
+    # Encabezados de artículo (offset, número) en una sola pasada
+    encabezados = [(m.start(), m.group(1)) for m in REGEX_ARTICULO.finditer(texto)]
+    offsets_encabezados = [offset for offset, _ in encabezados]
+
     # Crear chunks con superposición para mejor coherencia contextual
     chunks = []
+    metadatos = []
     start = 0
     
     while start < len(texto):
@@ -107,16 +752,30 @@ def pdf_a_chunks(file_path: str, chunk_size: int = CHUNK_SIZE, overlap_size: int
         
         # Si no es el último chunk, intentar cortar en un punto natural (punto, salto de línea)
         if end < len(texto):
-            # Buscar el último punto o salto de línea en los últimos 100 caracteres
-            natural_break = max(
-                chunk.rfind('.', max(0, len(chunk) - 100)),
-                chunk.rfind('\n', max(0, len(chunk) - 100))
-            )
-            if natural_break > 0:
-                chunk = chunk[:natural_break + 1]
-                end = start + len(chunk)
+            # Preferir el último encabezado de artículo de la segunda mitad: así los cortes no
+            # dependen de lo que haya antes y una reforma solo cambia los chunks de sus artículos
+            siguiente_articulo = bisect_right(offsets_encabezados, end) - 1
+            if siguiente_articulo >= 0 and offsets_encabezados[siguiente_articulo] > start + chunk_size // 2:
+                end = offsets_encabezados[siguiente_articulo]
+                chunk = texto[start:end]
+            else:
+                # Buscar el último punto o salto de línea en los últimos 100 caracteres
+                natural_break = max(
+                    chunk.rfind('.', max(0, len(chunk) - 100)),
+                    chunk.rfind('\n', max(0, len(chunk) - 100))
+                )
+                if natural_break > 0:
+                    chunk = chunk[:natural_break + 1]
+                    end = start + len(chunk)
         
         chunks.append(chunk.strip())
+
+        # Página donde empieza el chunk y artículos que abarca (incluido el que continúa desde antes)
+        pagina = numeros_pagina[max(0, bisect_right(inicios_pagina, start) - 1)]
+        primero = max(0, bisect_right(offsets_encabezados, start) - 1)
+        ultimo = bisect_left(offsets_encabezados, end)
+        articulos = list(dict.fromkeys(numero for _, numero in encabezados[primero:ultimo]))
+        metadatos.append({"pagina": pagina, "articulos": articulos})
         
         # Mover el inicio considerando la superposición
         if end >= len(texto):
@@ -124,12 +783,15 @@ def pdf_a_chunks(file_path: str, chunk_size: int = CHUNK_SIZE, overlap_size: int
         start = end - overlap_size
     
     # Filtrar chunks vacíos o muy pequeños
-    chunks = [chunk for chunk in chunks if len(chunk.strip()) > 50]
-    
-    vectores = model_embeddings.encode(chunks)
-    return chunks, vectores, tipo_doc
+    validos = [i for i, chunk in enumerate(chunks) if len(chunk.strip()) > 50]
+    chunks = [chunks[i] for i in validos]
+    metadatos = [metadatos[i] for i in validos]
+    return chunks, tipo_doc, metadatos, len(numeros_pagina)
+
+def construir_prompt(contexto: str, pregunta: str, tipo_documento: dict, tiene_contexto_relevante: bool = True, historial: str = "") -> str:
+    # Resumen de turnos anteriores de la sesión (tamaño acotado)
+    antecedentes = f"ANTECEDENTES DE LA CONVERSACIÓN:\n{historial}\n\n" if historial else ""
 
-def construir_prompt(contexto: str, pregunta: str, tipo_documento: dict, tiene_contexto_relevante: bool = True) -> str:
     if tiene_contexto_relevante:
         especialidad = tipo_documento.get('especialidad', 'Derecho General')
         descripcion = tipo_documento.get('descripcion', 'documento legal')
@@ -161,7 +823,7 @@ NOTIFÍQUESE Y CÚMPLASE.
 CONTEXTO LEGAL ({tipo}):
 {contexto}
 
-CASO A JUZGAR:
+{antecedentes}CASO A JUZGAR:
 {pregunta}
 
 IMPORTANTE: Basa tu sentencia ÚNICAMENTE en el {tipo} proporcionado. Cita artículos específicos."""
@@ -188,12 +850,166 @@ No aplicable hasta contar con legislación específica
 Esta sentencia provisional se basa en conocimiento general jurídico y NO en el documento específico proporcionado.
 Se requiere consultar la legislación correspondiente y asesoramiento legal especializado.
 
-CASO PRESENTADO:
+{antecedentes}CASO PRESENTADO:
 {pregunta}
 
 ⚠️ ADVERTENCIA JUDICIAL: Sentencia no definitiva por falta de marco legal específico."""
 
+# === Empaquetado de contexto por presupuesto de tokens ===
+@lru_cache(maxsize=None)
+def obtener_tokenizador(modelo: str):
+    """
+    Devuelve el tokenizador del modelo (tiktoken, cacheado en TIKTOKEN_CACHE_DIR para uso offline)
+    """
+    try:
+        try:
+            return tiktoken.encoding_for_model(modelo)
+        except KeyError:
+            return tiktoken.get_encoding("cl100k_base")
+    except Exception as e:
+        # Sin acceso al archivo BPE: se usa una estimación por caracteres
+        print(f"Tokenizador no disponible para {modelo}, usando estimación: {str(e)}")
+        return None
+
+def contar_tokens(texto: str, modelo: str = OPENAI_MODEL) -> int:
+    tokenizador = obtener_tokenizador(modelo)
+    if tokenizador is None:
+        return len(texto) // 4 + 1
+    return len(tokenizador.encode(texto, disallowed_special=()))
+
+def recortar_a_tokens(texto: str, max_tokens: int, modelo: str = OPENAI_MODEL) -> str:
+    tokenizador = obtener_tokenizador(modelo)
+    if tokenizador is None:
+        return texto[:max_tokens * 4]
+    tokens = tokenizador.encode(texto, disallowed_special=())
+    return tokenizador.decode(tokens[:max_tokens])
+
+def recortar_a_tokens_final(texto: str, max_tokens: int, modelo: str = OPENAI_MODEL) -> str:
+    # Conserva los últimos max_tokens tokens (lo más reciente del texto)
+    tokenizador = obtener_tokenizador(modelo)
+    if tokenizador is None:
+        return texto[-max_tokens * 4:]
+    tokens = tokenizador.encode(texto, disallowed_special=())
+    return tokenizador.decode(tokens[-max_tokens:]) if len(tokens) > max_tokens else texto
+
+def obtener_presupuesto_contexto(modelo: str) -> int:
+    if CONTEXT_TOKEN_BUDGET_DEFAULT > 0:
+        return CONTEXT_TOKEN_BUDGET_DEFAULT
+    return CONTEXT_TOKEN_BUDGETS.get(modelo, 3000)
+
+def unir_con_superposicion(texto_a: str, texto_b: str, max_superposicion: int = OVERLAP_SIZE + 100) -> str:
+    """
+    Une dos fragmentos consecutivos eliminando el tramo repetido por la superposición
+    """
+    inicio = max(0, len(texto_a) - max_superposicion)
+    for pos in range(inicio, len(texto_a)):
+        if texto_b.startswith(texto_a[pos:]):
+            return texto_a[:pos] + texto_b
+    return texto_a + "\n" + texto_b
+
+def empaquetar_contexto(resultados, modelo: str, presupuesto: int = None):
+    """
+    Fusiona fragmentos contiguos del mismo documento por chunk_index, elimina texto duplicado
+    y llena el presupuesto de tokens del modelo en orden de relevancia
+    """
+    presupuesto = presupuesto or obtener_presupuesto_contexto(modelo)
+
+    # Agrupar resultados contiguos (mismo documento, chunk_index consecutivos) en bloques;
+    # con varios códigos cargados el chunk_index solo es único dentro de cada documento
+    def clave(r):
+        return (r.payload.get("documento_tipo") or "", r.payload.get("chunk_index", 0))
+
+    ordenados = sorted(resultados, key=clave)
+    bloques = []
+    for resultado in ordenados:
+        documento, indice = clave(resultado)
+        texto = resultado.payload["text"]
+        if bloques and documento == bloques[-1]["documento"] and indice <= bloques[-1]["ultimo_indice"] + 1:
+            bloque = bloques[-1]
+            if indice > bloque["ultimo_indice"]:
+                bloque["texto"] = unir_con_superposicion(bloque["texto"], texto)
+                bloque["ultimo_indice"] = indice
+            bloque["score"] = max(bloque["score"], resultado.score)
+            bloque["cita_directa"] = bloque["cita_directa"] or bool(resultado.payload.get("cita_directa"))
+            bloque["fragmentos"] += 1
+        else:
+            bloques.append({
+                "texto": texto,
+                "documento": documento,
+                "ultimo_indice": indice,
+                "score": resultado.score,
+                "cita_directa": bool(resultado.payload.get("cita_directa")),
+                "fragmentos": 1
+            })
+
+    # Llenar el presupuesto en orden de relevancia, descartando bloques ya contenidos en otros
+    bloques.sort(key=lambda b: b["score"], reverse=True)
+    varios_documentos = len({bloque["documento"] for bloque in bloques}) > 1
+    partes = []
+    textos_incluidos = []
+    tokens_usados = 0
+    fragmentos_usados = 0
+    for bloque in bloques:
+        if any(bloque["texto"] in incluido for incluido in textos_incluidos):
+            continue
+
+        etiqueta = f"{bloque['documento']} | " if varios_documentos and bloque["documento"] else ""
+        relevancia = "Artículo citado" if bloque["cita_directa"] else f"Relevancia: {bloque['score']:.3f}"
+        parte = f"[{etiqueta}{relevancia}] {bloque['texto']}"
+        tokens_parte = contar_tokens(parte, modelo)
+        disponible = presupuesto - tokens_usados
+        if tokens_parte > disponible:
+            if partes:
+                continue
+            # El bloque más relevante siempre entra, recortado al presupuesto
+            parte = recortar_a_tokens(parte, disponible, modelo)
+            tokens_parte = disponible
+
+        partes.append(parte)
+        textos_incluidos.append(bloque["texto"])
+        tokens_usados += tokens_parte
+        fragmentos_usados += bloque["fragmentos"]
+
+    info = {
+        "fragmentos_recuperados": len(resultados),
+        "fragmentos_usados": fragmentos_usados,
+        "bloques_contexto": len(partes),
+        "tokens_contexto": tokens_usados,
+        "presupuesto_tokens": presupuesto
+    }
+    return "\n\n".join(partes), info
+
+def bloquear_archivo(candado):
+    # Bloqueo exclusivo entre procesos: flock en POSIX, msvcrt.locking sobre el primer byte en Windows
+    if fcntl is not None:
+        fcntl.flock(candado, fcntl.LOCK_EX)
+        return
+    candado.seek(0)
+    while True:
+        try:
+            msvcrt.locking(candado.fileno(), msvcrt.LK_NBLCK, 1)
+            return
+        except OSError:
+            time.sleep(0.05)
+
+def desbloquear_archivo(candado):
+    if fcntl is not None:
+        fcntl.flock(candado, fcntl.LOCK_UN)
+        return
+    candado.seek(0)
+    msvcrt.locking(candado.fileno(), msvcrt.LK_UNLCK, 1)
+
 def guardar_en_excel(pregunta: str, respuesta: str, path: str = EXCEL_PATH):
+    # Varios hilos y varios workers escriben el mismo libro: el bloqueo de archivo
+    # serializa la lectura-modificación-escritura entre procesos
+    with open(path + ".lock", "a+") as candado:
+        bloquear_archivo(candado)
+        try:
+            _guardar_en_excel(pregunta, respuesta, path)
+        finally:
+            desbloquear_archivo(candado)
+
+def _guardar_en_excel(pregunta: str, respuesta: str, path: str):
     if os.path.exists(path):
         wb = load_workbook(path)
         ws = wb.active
@@ -212,9 +1028,11 @@ def guardar_en_excel(pregunta: str, respuesta: str, path: str = EXCEL_PATH):
     wb.save(path)
 
 # Función para insertar puntos en lotes para evitar timeouts
-def insertar_puntos_en_lotes(chunks, vectores, tipo_documento, batch_size=BATCH_SIZE):
+def insertar_puntos_en_lotes(chunks, vectores, tipo_documento, batch_size=BATCH_SIZE, metadatos=None, id_base: int = 0,
+                             ids=None, indices_chunk=None):
     """
-    Inserta los puntos en Qdrant en lotes para evitar timeouts con documentos grandes
+    Inserta los puntos en Qdrant en lotes para evitar timeouts con documentos grandes.
+    ids e indices_chunk permiten insertar un subconjunto de chunks (sincronización incremental).
     """
     total_chunks = len(chunks)
     puntos_insertados = 0
@@ -228,13 +1046,14 @@ def insertar_puntos_en_lotes(chunks, vectores, tipo_documento, batch_size=BATCH_
         # Crear puntos para este lote
         puntos_lote = [
             PointStruct(
-                id=i + j, 
+                id=ids[i + j] if ids is not None else id_base + i + j,
                 vector=batch_vectores[j].tolist(), 
                 payload={
                     "text": batch_chunks[j], 
-                    "chunk_index": i + j,
+                    "chunk_index": indices_chunk[i + j] if indices_chunk is not None else i + j,
                     "documento_tipo": tipo_documento.get("tipo", "Documento Legal"),
-                    "documento_especialidad": tipo_documento.get("especialidad", "Derecho General")
+                    "documento_especialidad": tipo_documento.get("especialidad", "Derecho General"),
+                    **(metadatos[i + j] if metadatos else {})
                 }
             )
             for j in range(len(batch_chunks))
@@ -244,88 +1063,322 @@ def insertar_puntos_en_lotes(chunks, vectores, tipo_documento, batch_size=BATCH_
         max_reintentos = 3
         for intento in range(max_reintentos):
             try:
-                qdrant_client.upsert(collection_name=COLLECTION_NAME, points=puntos_lote)
+                consultar_qdrant(qdrant_client_carga.upsert, collection_name=COLLECTION_NAME, points=puntos_lote)
                 puntos_insertados += len(puntos_lote)
                 print(f"Lote {i//batch_size + 1} insertado exitosamente. Progreso: {puntos_insertados}/{total_chunks}")
                 break
+            except CircuitoAbierto as e:
+                # Qdrant marcado como caído: abortar la carga sin seguir esperando entre reintentos
+                raise Exception(f"Error al insertar lote {i//batch_size + 1}: {str(e)}")
             except Exception as e:
                 if intento == max_reintentos - 1:
                     raise Exception(f"Error al insertar lote después de {max_reintentos} intentos: {str(e)}")
                 print(f"Error en lote {i//batch_size + 1}, intento {intento + 1}: {str(e)}")
-                import time
                 time.sleep(2 ** intento)  # Backoff exponencial
     
     return puntos_insertados
 
-# Función para detectar el tipo de documento legal
-def detectar_tipo_documento(texto: str, filename: str = "") -> dict:
+# === Estadísticas del corpus ===
+def hash_fragmento(texto: str) -> str:
+    # Normaliza espacios y mayúsculas para detectar fragmentos duplicados
+    return hashlib.sha1(" ".join(texto.lower().split()).encode("utf-8")).hexdigest()[:16]
+
+def calcular_estadisticas_documento(chunks, vectores, metadatos, paginas_con_texto: int = None) -> dict:
     """
-    Detecta el tipo de documento legal basado en el contenido y nombre del archivo
+    Calcula en la ingesta las estadísticas exactas de un documento.
+    paginas_con_texto viene de la extracción; sin ella se cuentan las páginas donde empieza algún chunk.
     """
-    texto_lower = texto.lower()
-    filename_lower = filename.lower()
-    
-    # Patrones de identificación
-    patrones = {
-        "COIP": {
-            "keywords": ["código orgánico integral penal", "coip", "delitos", "penas", "infracciones penales", "homicidio", "robo", "estafa"],
-            "especialidad": "Derecho Penal",
-            "descripcion": "Código Orgánico Integral Penal"
-        },
-        "Código de Comercio": {
-            "keywords": ["código de comercio", "mercantil", "comerciante", "sociedad anónima", "contrato mercantil", "empresa"],
-            "especialidad": "Derecho Mercantil",
-            "descripcion": "Código de Comercio"
-        },
-        "Código de la Niñez": {
-            "keywords": ["código de la niñez", "niños", "adolescentes", "menores", "patria potestad", "tutela"],
-            "especialidad": "Derecho de Familia y Niñez",
-            "descripcion": "Código de la Niñez y Adolescencia"
-        },
-        "Código Civil": {
-            "keywords": ["código civil", "derecho civil", "personas", "bienes", "obligaciones", "contratos civiles"],
-            "especialidad": "Derecho Civil",
-            "descripcion": "Código Civil"
-        },
-        "Constitución": {
-            "keywords": ["constitución", "derechos fundamentales", "garantías constitucionales", "estado", "poderes públicos"],
-            "especialidad": "Derecho Constitucional",
-            "descripcion": "Constitución"
-        }
+    longitudes = [len(chunk) for chunk in chunks]
+    modelo = leer_modelo_actual()
+    tokens = [contar_tokens(chunk, modelo) for chunk in chunks]
+    normas = np.linalg.norm(np.asarray(vectores, dtype=np.float32), axis=1) if len(chunks) else np.zeros(0)
+
+    histograma = {}
+    for longitud in longitudes:
+        intervalo = (longitud // ANCHO_HISTOGRAMA) * ANCHO_HISTOGRAMA
+        histograma[intervalo] = histograma.get(intervalo, 0) + 1
+
+    por_pagina = {}
+    por_articulo = {}
+    for meta in metadatos:
+        por_pagina[meta["pagina"]] = por_pagina.get(meta["pagina"], 0) + 1
+        for articulo in meta["articulos"]:
+            por_articulo[articulo] = por_articulo.get(articulo, 0) + 1
+
+    return {
+        "fragmentos": len(chunks),
+        "caracteres": sum(longitudes),
+        "longitud_minima": min(longitudes, default=0),
+        "longitud_maxima": max(longitudes, default=0),
+        "histograma_longitudes": {str(k): v for k, v in sorted(histograma.items())},
+        "tokens": sum(tokens),
+        "tokens_maximo_fragmento": max(tokens, default=0),
+        "modelo_tokenizador": modelo,
+        "norma_suma": float(normas.sum()),
+        "norma_minima": float(normas.min()) if len(normas) else 0.0,
+        "norma_maxima": float(normas.max()) if len(normas) else 0.0,
+        "fragmentos_por_pagina": {str(k): v for k, v in sorted(por_pagina.items())},
+        "paginas_con_texto": paginas_con_texto if paginas_con_texto is not None else len(por_pagina),
+        "fragmentos_por_articulo": por_articulo,
+        "hashes": [hash_fragmento(chunk) for chunk in chunks]
     }
-    
-    # Detectar por nombre de archivo primero
+
+def recalcular_totales_corpus():
+    """
+    Combina las estadísticas de todos los documentos registrados en los totales del corpus.
+    Se paga al escribir (cargar, actualizar o borrar un documento), no al consultar. Casi todo se
+    combina por documento, pero los duplicados unen los hashes de todos los fragmentos, así que
+    el costo crece con el tamaño del corpus.
+    """
+    documentos = listar_estado("estadisticas_documento:")
+    if not documentos:
+        borrar_estado("estadisticas_corpus")
+        return
+
+    histograma = {}
+    por_articulo = {}
+    hashes_unicos = set()
+    fragmentos = 0
+    for stats in documentos.values():
+        fragmentos += stats["fragmentos"]
+        for intervalo, cantidad in stats["histograma_longitudes"].items():
+            histograma[intervalo] = histograma.get(intervalo, 0) + cantidad
+        for articulo, cantidad in stats["fragmentos_por_articulo"].items():
+            por_articulo[articulo] = por_articulo.get(articulo, 0) + cantidad
+        hashes_unicos.update(stats["hashes"])
+
+    # Tamaño de cada shard: lo usa el enrutador para reportar la reducción del espacio de búsqueda
+    por_especialidad = {}
+    especialidad_anterior = leer_documento_actual().get("especialidad") or "Derecho General"
+    for stats in documentos.values():
+        especialidad = stats.get("especialidad", especialidad_anterior)
+        por_especialidad[especialidad] = por_especialidad.get(especialidad, 0) + stats["fragmentos"]
+
+    caracteres = sum(stats["caracteres"] for stats in documentos.values())
+    tokens = sum(stats["tokens"] for stats in documentos.values())
+    guardar_estado("estadisticas_corpus", {
+        "documentos": sorted(clave.split(":", 1)[1] for clave in documentos),
+        "total_fragmentos": fragmentos,
+        "fragmentos_por_especialidad": por_especialidad,
+        "total_caracteres": caracteres,
+        "longitud_promedio": round(caracteres / fragmentos, 2) if fragmentos else 0,
+        "longitud_minima": min(stats["longitud_minima"] for stats in documentos.values()),
+        "longitud_maxima": max(stats["longitud_maxima"] for stats in documentos.values()),
+        "histograma_longitudes": dict(sorted(histograma.items(), key=lambda item: int(item[0]))),
+        "total_tokens": tokens,
+        "tokens_promedio_fragmento": round(tokens / fragmentos, 2) if fragmentos else 0,
+        "tokens_maximo_fragmento": max(stats["tokens_maximo_fragmento"] for stats in documentos.values()),
+        "norma_embedding_promedio": round(sum(stats["norma_suma"] for stats in documentos.values()) / fragmentos, 6) if fragmentos else 0,
+        "norma_embedding_minima": min(stats["norma_minima"] for stats in documentos.values()),
+        "norma_embedding_maxima": max(stats["norma_maxima"] for stats in documentos.values()),
+        "total_paginas_con_texto": sum(stats.get("paginas_con_texto", len(stats["fragmentos_por_pagina"])) for stats in documentos.values()),
+        "articulos_distintos": len(por_articulo),
+        "fragmentos_por_articulo_promedio": round(sum(por_articulo.values()) / len(por_articulo), 2) if por_articulo else 0,
+        "fragmentos_duplicados": fragmentos - len(hashes_unicos),
+        "ratio_duplicados": round((fragmentos - len(hashes_unicos)) / fragmentos, 4) if fragmentos else 0,
+        "actualizado": datetime.now().isoformat()
+    })
+
+def registrar_estadisticas_documento(filename: str, estadisticas: dict):
+    guardar_estado(f"estadisticas_documento:{filename}", estadisticas)
+    recalcular_totales_corpus()
+
+def eliminar_estadisticas_documento(filename: str = None):
+    # Sin filename se eliminan las estadísticas de todos los documentos
+    claves = [f"estadisticas_documento:{filename}"] if filename else list(listar_estado("estadisticas_documento:"))
+    for clave in claves:
+        borrar_estado(clave)
+    recalcular_totales_corpus()
+
+# === Índice directo de artículos ===
+# Mapa {tipo de documento: {número de artículo: [IDs de chunks]}} construido en la ingesta
+# y guardado en el estado compartido; las consultas que citan un artículo lo leen en O(1)
+def construir_indice_articulos(tipo: str, metadatos, ids) -> dict:
+    indice = {}
+    for id_punto, meta in zip(ids, metadatos):
+        for articulo in meta.get("articulos") or []:
+            indice.setdefault(articulo, []).append(id_punto)
+    return {tipo: indice}
+
+def registrar_indice_articulos(indice: dict, reemplazar: bool = True):
+    actual = {} if reemplazar else leer_estado("indice_articulos", {})
+    guardar_estado("indice_articulos", {**actual, **indice})
+
+def extraer_citas_articulos(pregunta: str) -> list:
+    """
+    Detecta referencias explícitas a artículos: "art. 140", "artículo 140", "arts. 196 y 197 COIP"
+    """
+    citas = []
+    for match in obtener_clasificador()["regex_citas"].finditer(pregunta):
+        citas.extend(re.findall(r"\d+", match.group(1)))
+    return list(dict.fromkeys(citas))
+
+def documentos_citados(pregunta: str, tipos_indexados) -> list:
+    # Si la pregunta nombra un código ("del COIP") solo se busca en ese; si no, en todos
+    pregunta_lower = pregunta.lower()
+    patrones = obtener_clasificador()["patrones"]
+    citados = [
+        tipo for tipo in tipos_indexados
+        if tipo.lower() in pregunta_lower
+        or any(keyword.lower() in pregunta_lower for keyword in patrones.get(tipo, {}).get("keywords", [])[:2])
+    ]
+    return citados or list(tipos_indexados)
+
+def buscar_articulos_citados(pregunta: str):
+    """
+    Devuelve los chunks de los artículos citados en la pregunta, sin pasar por la búsqueda vectorial
+    """
+    citas = extraer_citas_articulos(pregunta)
+    if not citas:
+        return [], {"indice_articulos_usado": False, "articulos_citados": []}
+
+    indice = leer_estado("indice_articulos", {})
+    ids = []
+    encontrados = []
+    for tipo in documentos_citados(pregunta, indice):
+        for articulo in citas:
+            ids_articulo = indice[tipo].get(articulo)
+            if ids_articulo:
+                ids.extend(ids_articulo[:MAX_CHUNKS_POR_ARTICULO])
+                encontrados.append(f"{tipo} Art. {articulo}")
+
+    if not ids:
+        return [], {"indice_articulos_usado": False, "articulos_citados": citas}
+
+    registros = consultar_qdrant(
+        qdrant_client.retrieve,
+        collection_name=COLLECTION_NAME,
+        ids=list(dict.fromkeys(ids)),
+        with_payload=CAMPOS_PAYLOAD_CONTEXTO,
+        with_vectors=False
+    )
+    # Puntaje máximo: la cita explícita tiene prioridad sobre la similitud semántica
+    # (marcados como cita_directa para no reportar ese 1.0 como relevancia semántica)
+    directos = [ScoredPoint(id=r.id, version=0, score=1.0, payload={**r.payload, "cita_directa": True}) for r in registros]
+    return directos, {"indice_articulos_usado": True, "articulos_citados": citas, "articulos_encontrados": encontrados}
+
+def combinar_resultados(directos, resultados):
+    ids_directos = {r.id for r in directos}
+    return directos + [r for r in resultados if r.id not in ids_directos]
+
+# === Clasificador de documentos y preguntas ===
+def cargar_patrones(path: str = PATRONES_PATH) -> dict:
+    """
+    Carga el registro de patrones e indexa los keywords (en minúsculas) con los tipos que los usan
+    """
+    with open(path, "r", encoding="utf-8") as f:
+        patrones = json.load(f)
+
+    keyword_a_tipos = {}
     for tipo, info in patrones.items():
-        if any(keyword in filename_lower for keyword in info["keywords"][:2]):  # Solo los primeros 2 keywords más específicos
-            return {
-                "tipo": tipo,
-                "especialidad": info["especialidad"],
-                "descripcion": info["descripcion"],
-                "confianza": "alta",
-                "metodo": "filename"
-            }
-    
-    # Detectar por contenido
+        for keyword in info["keywords"]:
+            keyword_a_tipos.setdefault(keyword.lower(), []).append(tipo)
+
+    # Nombres de cada código para las citas: el tipo y su primer keyword (el nombre completo)
+    nombres_codigos = sorted(
+        {nombre.lower() for tipo, info in patrones.items() for nombre in [tipo] + info["keywords"][:1]},
+        key=len,
+        reverse=True
+    )
+    regex_citas = re.compile(
+        REGEX_CITA_ARTICULO.format(codigos="".join(f"|{re.escape(nombre)}\\b" for nombre in nombres_codigos)),
+        re.IGNORECASE
+    )
+
+    return {
+        "patrones": patrones,
+        "keyword_a_tipos": keyword_a_tipos,
+        "regex_citas": regex_citas,
+        "max_longitud_keyword": max((len(k) for k in keyword_a_tipos), default=1),
+        "mtime": os.path.getmtime(path)
+    }
+
+clasificador = cargar_patrones()
+
+def obtener_clasificador() -> dict:
+    """
+    Devuelve el clasificador, recompilándolo si el archivo de patrones cambió
+    """
+    global clasificador
+    try:
+        if os.path.getmtime(PATRONES_PATH) != clasificador["mtime"]:
+            clasificador = cargar_patrones()
+            print(f"Patrones recargados desde {PATRONES_PATH}: {len(clasificador['patrones'])} tipos")
+    except Exception as e:
+        print(f"Error al recargar patrones, se mantienen los anteriores: {str(e)}")
+    return clasificador
+
+def puntuar_texto(texto: str, parada_temprana: bool = True) -> dict:
+    """
+    Cuenta los keywords distintos de cada tipo recorriendo el texto por bloques; cada keyword
+    se busca solo hasta encontrarlo una vez (compartido entre los tipos que lo usan).
+    Con parada_temprana se detiene cuando el líder alcanza confianza alta con margen suficiente.
+    """
+    clf = obtener_clasificador()
+    pendientes = list(clf["keyword_a_tipos"])
     scores = {}
-    for tipo, info in patrones.items():
-        score = sum(1 for keyword in info["keywords"] if keyword in texto_lower)
-        if score > 0:
-            scores[tipo] = score
-    
+    solape = clf["max_longitud_keyword"] - 1
+
+    # Recorrer por bloques para no tener que pasar a minúsculas todo el texto si se decide antes
+    for inicio in range(0, len(texto), TAM_BLOQUE_CLASIFICACION):
+        bloque = texto[inicio:inicio + TAM_BLOQUE_CLASIFICACION + solape].lower()
+        restantes = []
+        for keyword in pendientes:
+            if keyword in bloque:
+                for tipo in clf["keyword_a_tipos"][keyword]:
+                    scores[tipo] = scores.get(tipo, 0) + 1
+            else:
+                restantes.append(keyword)
+        pendientes = restantes
+        if not pendientes:
+            break
+
+        if parada_temprana and scores:
+            ordenados = sorted(scores.values(), reverse=True)
+            segundo = ordenados[1] if len(ordenados) > 1 else 0
+            if ordenados[0] >= UMBRAL_CONFIANZA_ALTA and ordenados[0] - segundo >= MARGEN_PARADA_TEMPRANA:
+                break
+
+    return scores
+
+def clasificar_texto(texto: str, filename: str = "", parada_temprana: bool = True) -> dict:
+    """
+    Clasifica un texto (documento completo o pregunta) según el registro de patrones
+    """
+    clf = obtener_clasificador()
+    patrones = clf["patrones"]
+    filename_lower = filename.lower()
+
+    # Detectar por nombre de archivo primero
+    if filename_lower:
+        for tipo, info in patrones.items():
+            if any(keyword.lower() in filename_lower for keyword in info["keywords"][:2]):  # Solo los primeros 2 keywords más específicos
+                return {
+                    "tipo": tipo,
+                    "especialidad": info["especialidad"],
+                    "descripcion": info["descripcion"],
+                    "confianza": "alta",
+                    "metodo": "filename"
+                }
+
+    # Detectar por contenido
+    scores = puntuar_texto(texto, parada_temprana)
+
     if scores:
         tipo_detectado = max(scores, key=scores.get)
         max_score = scores[tipo_detectado]
-        confianza = "alta" if max_score >= 3 else "media" if max_score >= 2 else "baja"
-        
+        confianza = "alta" if max_score >= UMBRAL_CONFIANZA_ALTA else "media" if max_score >= 2 else "baja"
+
         return {
             "tipo": tipo_detectado,
             "especialidad": patrones[tipo_detectado]["especialidad"],
             "descripcion": patrones[tipo_detectado]["descripcion"],
             "confianza": confianza,
             "metodo": "contenido",
-            "score": max_score
+            "score": max_score,
+            "scores": scores
         }
-    
+
     # Documento genérico si no se detecta
     return {
         "tipo": "Documento Legal Genérico",
@@ -335,30 +1388,191 @@ def detectar_tipo_documento(texto: str, filename: str = "") -> dict:
         "metodo": "generico"
     }
 
+# Función para detectar el tipo de documento legal
+def detectar_tipo_documento(texto: str, filename: str = "") -> dict:
+    """
+    Detecta el tipo de documento legal basado en el contenido y nombre del archivo
+    """
+    return clasificar_texto(texto, filename)
+
+def clasificar_pregunta(pregunta: str) -> dict:
+    """
+    Clasifica una pregunta entrante para enrutarla a la especialidad correspondiente
+    """
+    return clasificar_texto(pregunta, parada_temprana=False)
+
+# === Enrutamiento de preguntas por especialidad ===
+# Cada especialidad es un shard de la colección (índice tenant sobre documento_especialidad).
+# Las preguntas con confianza suficiente solo buscan en los shards de sus especialidades.
+metricas_enrutamiento = {
+    "consultas": 0,
+    "enrutadas": 0,
+    "globales": 0,
+    "fallback_sin_resultados": 0,
+    "fragmentos_buscados": 0,
+    "fragmentos_totales": 0,
+    "tiempo_busqueda_ms": {"especialidad": 0.0, "global": 0.0}
+}
+lock_metricas_enrutamiento = threading.Lock()
+
+def enrutar_pregunta(pregunta: str, clasificacion: dict = None) -> dict:
+    """
+    Decide en qué especialidades buscar. Se incluyen los tipos con al menos UMBRAL_CONFIANZA_RUTEO
+    keywords y la mitad del puntaje del líder, siempre que tengan documentos cargados.
+    """
+    clasificacion = clasificacion or clasificar_pregunta(pregunta)
+    patrones = obtener_clasificador()["patrones"]
+    corpus = leer_estado("estadisticas_corpus") or {}
+    por_especialidad = corpus.get("fragmentos_por_especialidad", {})
+    total = corpus.get("total_fragmentos", 0)
+
+    scores = clasificacion.get("scores") or {}
+    lider = max(scores.values(), default=0)
+    especialidades = []
+    for tipo, score in sorted(scores.items(), key=lambda item: item[1], reverse=True):
+        especialidad = patrones.get(tipo, {}).get("especialidad")
+        if score >= UMBRAL_CONFIANZA_RUTEO and score * 2 >= lider and especialidad in por_especialidad:
+            if especialidad not in especialidades:
+                especialidades.append(especialidad)
+
+    if lider < UMBRAL_CONFIANZA_RUTEO:
+        motivo = "confianza_baja"
+    elif not especialidades:
+        motivo = "especialidad_sin_documentos"
+    elif len(especialidades) == len(por_especialidad):
+        motivo = "todas_las_especialidades"
+    else:
+        motivo = "clasificacion"
+
+    if motivo != "clasificacion":
+        especialidades = []
+    buscados = sum(por_especialidad[e] for e in especialidades) if especialidades else total
+    return {
+        "modo": "especialidad" if especialidades else "global",
+        "motivo": motivo,
+        "especialidades": especialidades,
+        "fragmentos_buscados": buscados,
+        "fragmentos_totales": total,
+        "reduccion_espacio_busqueda": round(1 - buscados / total, 4) if total else 0.0
+    }
+
+def registrar_enrutamiento(ruta: dict):
+    with lock_metricas_enrutamiento:
+        metricas_enrutamiento["consultas"] += 1
+        metricas_enrutamiento["enrutadas" if ruta["modo"] == "especialidad" else "globales"] += 1
+        if ruta["motivo"] == "sin_resultados_en_especialidad":
+            metricas_enrutamiento["fallback_sin_resultados"] += 1
+        metricas_enrutamiento["fragmentos_buscados"] += ruta["fragmentos_buscados"]
+        metricas_enrutamiento["fragmentos_totales"] += ruta["fragmentos_totales"]
+        metricas_enrutamiento["tiempo_busqueda_ms"][ruta["modo"]] += ruta.get("tiempo_busqueda_ms", 0.0)
+
+def reenrutar_a_global(ruta: dict):
+    # Los shards elegidos no tienen nada por encima del umbral: se repite la búsqueda en todo el corpus
+    ruta.update({
+        "modo": "global",
+        "motivo": "sin_resultados_en_especialidad",
+        "especialidades_intentadas": ruta["especialidades"],
+        "especialidades": [],
+        "fragmentos_buscados": ruta["fragmentos_buscados"] + ruta["fragmentos_totales"],
+        "reduccion_espacio_busqueda": round(-ruta["fragmentos_buscados"] / ruta["fragmentos_totales"], 4) if ruta["fragmentos_totales"] else 0.0
+    })
+
+def buscar_contexto_enrutado(vector, ruta: dict, limit: int = SEARCH_LIMIT):
+    """
+    Busca en los shards de la ruta y vuelve a la búsqueda global si no hay resultados
+    """
+    inicio = time.perf_counter()
+    resultados = buscar_contexto(vector, limit, especialidades=ruta["especialidades"])
+    if not resultados and ruta["modo"] == "especialidad":
+        reenrutar_a_global(ruta)
+        resultados = buscar_contexto(vector, limit)
+    ruta["tiempo_busqueda_ms"] = round((time.perf_counter() - inicio) * 1000, 2)
+    registrar_enrutamiento(ruta)
+    return resultados
+
+def buscar_lote_enrutado(vectores, rutas, limit: int = SEARCH_LIMIT):
+    """
+    Equivalente por lotes de buscar_contexto_enrutado: un search_batch con el filtro de cada
+    pregunta y un segundo search_batch global solo para las que quedaron sin resultados
+    """
+    def solicitud(vector, especialidades=None):
+        return SearchRequest(
+            vector=vector.tolist(),
+            filter=filtro_especialidades(especialidades),
+            limit=limit,
+            score_threshold=MIN_SIMILARITY_THRESHOLD,
+            with_payload=False if MODO_BUSQUEDA == "ids" else CAMPOS_PAYLOAD_CONTEXTO
+        )
+
+    inicio = time.perf_counter()
+    resultados_lote = consultar_qdrant(
+        qdrant_client.search_batch,
+        collection_name=COLLECTION_NAME,
+        requests=[solicitud(vector, ruta["especialidades"]) for vector, ruta in zip(vectores, rutas)]
+    )
+
+    sin_resultados = [i for i, ruta in enumerate(rutas) if ruta["modo"] == "especialidad" and not resultados_lote[i]]
+    if sin_resultados:
+        globales = consultar_qdrant(
+            qdrant_client.search_batch,
+            collection_name=COLLECTION_NAME,
+            requests=[solicitud(vectores[i]) for i in sin_resultados]
+        )
+        for i, resultados in zip(sin_resultados, globales):
+            reenrutar_a_global(rutas[i])
+            resultados_lote[i] = resultados
+
+    if MODO_BUSQUEDA == "ids":
+        # Un solo retrieve con los textos de todas las preguntas del lote
+        completar_payloads([r for resultados in resultados_lote for r in resultados])
+
+    # Tiempo repartido entre las preguntas del lote
+    tiempo_ms = round((time.perf_counter() - inicio) * 1000 / max(len(rutas), 1), 2)
+    for ruta in rutas:
+        ruta["tiempo_busqueda_ms"] = tiempo_ms
+        registrar_enrutamiento(ruta)
+    return resultados_lote
+
+def resumen_enrutamiento() -> dict:
+    with lock_metricas_enrutamiento:
+        m = {**metricas_enrutamiento, "tiempo_busqueda_ms": dict(metricas_enrutamiento["tiempo_busqueda_ms"])}
+    return {
+        **m,
+        "reduccion_espacio_busqueda_promedio": round(1 - m["fragmentos_buscados"] / m["fragmentos_totales"], 4) if m["fragmentos_totales"] else 0.0,
+        "tiempo_busqueda_promedio_ms": {
+            "especialidad": round(m["tiempo_busqueda_ms"]["especialidad"] / m["enrutadas"], 2) if m["enrutadas"] else None,
+            "global": round(m["tiempo_busqueda_ms"]["global"] / m["globales"], 2) if m["globales"] else None
+        }
+    }
+
 # === Endpoints ===
 # Verificar estado del servicio
 @app.get("/status", summary="Verificar estado del servicio")
 async def check_status():
     try:
-        # Verificar conexión con Qdrant
-        collections = qdrant_client.get_collections().collections
+        # Verificar conexión con Qdrant (falla al instante si su circuito está abierto).
+        # Las comprobaciones bloquean (la de OpenAI puede esperar en la cola del gobernador): van en hilos
+        collections = (await asyncio.to_thread(consultar_qdrant, qdrant_client.get_collections)).collections
         collection_names = [collection.name for collection in collections]
         
-        # Verificar API de OpenAI
-        test_response = generar_respuesta_openai("Hola, di 'OK' si funcionas correctamente", "test")
+        # Verificar API de OpenAI (sin llamada si su circuito está abierto)
+        openai_conectado = not circuito_openai.abierto()
+        test_response = await asyncio.to_thread(generar_respuesta_openai, "Hola, di 'OK' si funcionas correctamente", "test") if openai_conectado else None
         
         return {
-            "estado": "ok",
+            "estado": "ok" if openai_conectado else "degradado",
             "qdrant_conectado": True,
-            "openai_conectado": True,
+            "openai_conectado": openai_conectado,
             "colecciones_disponibles": collection_names,
             "test_openai": test_response,
+            "circuitos": {"qdrant": circuito_qdrant.estado(), "openai": circuito_openai.estado()},
             "version": "1.0.0"
         }
     except Exception as e:
         return {
             "estado": "error",
-            "mensaje": str(e)
+            "mensaje": str(e),
+            "circuitos": {"qdrant": circuito_qdrant.estado(), "openai": circuito_openai.estado()}
         }
 
 # Subir documento PDF y cargar a Qdrant
@@ -381,7 +1595,7 @@ async def subir_documento(file: UploadFile = File(...)):
 
         # Procesar PDF y extraer texto
         try:
-            chunks, vectores, tipo_documento = pdf_a_chunks(ruta)
+            chunks, vectores, tipo_documento, metadatos, paginas_con_texto = await asyncio.to_thread(pdf_a_chunks, ruta)
         except ValueError as ve:
             raise HTTPException(status_code=400, detail=f"Error al procesar PDF: {str(ve)}")
         except Exception as e:
@@ -391,28 +1605,28 @@ async def subir_documento(file: UploadFile = File(...)):
         if not chunks:
             raise HTTPException(status_code=400, detail="No se pudo extraer texto del PDF")
 
-        # Actualizar información del documento actual
-        global documento_actual
-        documento_actual.update({
-            "tipo": tipo_documento.get("tipo"),
-            "especialidad": tipo_documento.get("especialidad"),
-            "descripcion": tipo_documento.get("descripcion"),
-            "filename": file.filename,
-            "fecha_carga": datetime.now().isoformat()
-        })
-
-        # Inicializar colección de Qdrant
+        # Preparar la colección: se conservan los códigos de otras especialidades
+        # y se reemplaza la versión anterior del mismo tipo de documento
         try:
-            inicializar_qdrant()
+            asegurar_coleccion()
+            eliminar_documento_tipo(tipo_documento.get("tipo"))
+            id_base = reservar_ids(len(chunks))
         except Exception as e:
             raise HTTPException(status_code=500, detail=f"Error al inicializar Qdrant: {str(e)}")
 
-        # Insertar puntos en lotes para evitar timeouts
+        # Insertar puntos en lotes para evitar timeouts (en un hilo: las esperas entre reintentos no bloquean el servidor)
         try:
-            puntos_insertados = insertar_puntos_en_lotes(chunks, vectores, tipo_documento)
+            puntos_insertados = await asyncio.to_thread(
+                insertar_puntos_en_lotes, chunks, vectores, tipo_documento, metadatos=metadatos, id_base=id_base
+            )
         except Exception as e:
             raise HTTPException(status_code=500, detail=f"Error al cargar documento en Qdrant: {str(e)}")
 
+        # Documento actual, estadísticas e índice de artículos (IDs del rango reservado)
+        registrar_documento_cargado(
+            file.filename, tipo_documento, chunks, vectores, metadatos, range(id_base, id_base + len(chunks)), paginas_con_texto
+        )
+
         return {
             "estado": "ok",
             "fragmentos_cargados": puntos_insertados,
@@ -441,88 +1655,432 @@ async def subir_documento(file: UploadFile = File(...)):
         print(f"Error detallado en subir_documento: {error_detalle}")
         raise HTTPException(status_code=500, detail=f"Error interno del servidor: {str(e)}")
 
+# === Sincronización incremental (reformas de un código ya cargado) ===
+# Los chunks de la nueva versión se alinean con los puntos indexados del mismo tipo de documento:
+# primero por hash de contenido (sin cambios: no se re-embeben), luego por número de artículo
+# (modificados: se re-embeben reutilizando el ID). Lo que sobra son chunks añadidos o puntos eliminados.
+def leer_puntos_documento(tipo: str) -> list:
+    """
+    Lee los puntos indexados de un tipo de documento, con sus vectores, en orden de chunk
+    """
+    puntos = []
+    offset = None
+    while True:
+        lote, offset = consultar_qdrant(
+            qdrant_client_carga.scroll,
+            collection_name=COLLECTION_NAME,
+            scroll_filter=Filter(must=[FieldCondition(key="documento_tipo", match=MatchValue(value=tipo))]),
+            limit=SNAPSHOT_BATCH_SIZE,
+            offset=offset,
+            with_payload=CAMPOS_PAYLOAD_CONTEXTO,
+            with_vectors=True
+        )
+        puntos.extend(lote)
+        if offset is None:
+            break
+    return sorted(puntos, key=lambda punto: punto.payload.get("chunk_index", 0))
+
+def clave_articulo(meta: dict) -> str:
+    # Artículo donde empieza el chunk ("" para el texto previo al primer artículo)
+    return (meta.get("articulos") or [""])[0]
+
+def alinear_chunks(chunks, metadatos, anteriores) -> dict:
+    """
+    Empareja cada chunk nuevo con un punto indexado: por hash, y si no por artículo
+    """
+    por_hash = {}
+    for punto in anteriores:
+        por_hash.setdefault(hash_fragmento(punto.payload.get("text", "")), deque()).append(punto)
+
+    asignados = [None] * len(chunks)
+    for i, chunk in enumerate(chunks):
+        candidatos = por_hash.get(hash_fragmento(chunk))
+        if candidatos:
+            asignados[i] = candidatos.popleft()
+
+    usados = {punto.id for punto in asignados if punto is not None}
+    libres_por_articulo = {}
+    for punto in anteriores:
+        if punto.id not in usados:
+            libres_por_articulo.setdefault(clave_articulo(punto.payload), deque()).append(punto)
+
+    sin_cambios, modificados, añadidos = [], [], []
+    for i, punto in enumerate(asignados):
+        if punto is not None:
+            sin_cambios.append((i, punto))
+            continue
+        libres = libres_por_articulo.get(clave_articulo(metadatos[i]))
+        if libres:
+            modificados.append((i, libres.popleft()))
+        else:
+            añadidos.append(i)
+
+    eliminados = [punto.id for libres in libres_por_articulo.values() for punto in libres]
+    return {"sin_cambios": sin_cambios, "modificados": modificados, "añadidos": añadidos, "eliminados": eliminados}
+
+def sincronizar_documento(ruta: str, filename: str) -> dict:
+    """
+    Actualiza en Qdrant un código ya cargado embebiendo solo los chunks nuevos o modificados
+    """
+    inicio = time.monotonic()
+    chunks, tipo_documento, metadatos, paginas_con_texto = extraer_chunks_pdf(ruta)
+    if not chunks:
+        raise HTTPException(status_code=400, detail="No se pudo extraer texto del PDF")
+    tipo = tipo_documento.get("tipo")
+
+    asegurar_coleccion()
+    anteriores = leer_puntos_documento(tipo)
+    plan = alinear_chunks(chunks, metadatos, anteriores)
+
+    # Solo se embeben los chunks añadidos y los modificados
+    pendientes = [(i, punto.id) for i, punto in plan["modificados"]]
+    if plan["añadidos"]:
+        id_base = reservar_ids(len(plan["añadidos"]))
+        pendientes += [(i, id_base + n) for n, i in enumerate(plan["añadidos"])]
+    pendientes.sort()
+    indices = [i for i, _ in pendientes]
+    vectores_nuevos = model_embeddings.encode([chunks[i] for i in indices]) if indices else np.zeros((0, MODEL_DIM), dtype=np.float32)
+
+    if indices:
+        insertar_puntos_en_lotes(
+            [chunks[i] for i in indices], vectores_nuevos, tipo_documento,
+            metadatos=[metadatos[i] for i in indices], ids=[id_punto for _, id_punto in pendientes], indices_chunk=indices
+        )
+
+    # Sin cambios de texto pero desplazados (posición, página o artículos): solo se actualiza el payload
+    operaciones = [
+        SetPayloadOperation(set_payload=SetPayload(
+            payload={"chunk_index": i, "pagina": metadatos[i]["pagina"], "articulos": metadatos[i]["articulos"]},
+            points=[punto.id]
+        ))
+        for i, punto in plan["sin_cambios"]
+        if (punto.payload.get("chunk_index"), punto.payload.get("pagina"), punto.payload.get("articulos"))
+        != (i, metadatos[i]["pagina"], metadatos[i]["articulos"])
+    ]
+    for j in range(0, len(operaciones), SNAPSHOT_BATCH_SIZE):
+        consultar_qdrant(
+            qdrant_client_carga.batch_update_points,
+            collection_name=COLLECTION_NAME,
+            update_operations=operaciones[j:j + SNAPSHOT_BATCH_SIZE]
+        )
+
+    if plan["eliminados"]:
+        consultar_qdrant(
+            qdrant_client_carga.delete,
+            collection_name=COLLECTION_NAME,
+            points_selector=PointIdsList(points=plan["eliminados"]),
+            wait=True
+        )
+
+    # Vectores y IDs finales en orden de chunk para las estadísticas y el índice de artículos
+    ids = [None] * len(chunks)
+    vectores = np.zeros((len(chunks), MODEL_DIM), dtype=np.float32)
+    for i, punto in plan["sin_cambios"]:
+        ids[i] = punto.id
+        vectores[i] = punto.vector
+    for n, (i, id_punto) in enumerate(pendientes):
+        ids[i] = id_punto
+        vectores[i] = vectores_nuevos[n]
+
+    borrar_estadisticas_tipo(tipo)
+    registrar_documento_cargado(filename, tipo_documento, chunks, vectores, metadatos, ids, paginas_con_texto)
+
+    return {
+        "estado": "ok",
+        "archivo": filename,
+        "documento_tipo": tipo,
+        "fragmentos_anteriores": len(anteriores),
+        "fragmentos_actuales": len(chunks),
+        "añadidos": len(plan["añadidos"]),
+        "modificados": len(plan["modificados"]),
+        "eliminados": len(plan["eliminados"]),
+        "sin_cambios": len(plan["sin_cambios"]),
+        "payloads_actualizados": len(operaciones),
+        "fragmentos_embebidos": len(indices),
+        "tiempo_s": round(time.monotonic() - inicio, 2)
+    }
+
+@app.post("/documento/actualizar", summary="Actualizar un código ya cargado re-indexando solo lo que cambió")
+async def actualizar_documento(file: UploadFile = File(...)):
+    if not file.filename.endswith(".pdf"):
+        raise HTTPException(status_code=400, detail="Solo se aceptan archivos .pdf")
+
+    file_content = await file.read()
+    if len(file_content) > 50 * 1024 * 1024:  # 50MB
+        raise HTTPException(status_code=400, detail="El archivo es demasiado grande. Máximo 50MB.")
+
+    ruta = os.path.join(UPLOAD_FOLDER, file.filename)
+    with open(ruta, "wb") as f:
+        f.write(file_content)
+
+    try:
+        return await asyncio.to_thread(sincronizar_documento, ruta, file.filename)
+    except HTTPException:
+        raise
+    except ValueError as ve:
+        raise HTTPException(status_code=400, detail=f"Error al procesar PDF: {str(ve)}")
+    except Exception as e:
+        import traceback
+        print(f"Error detallado en actualizar_documento: {traceback.format_exc()}")
+        raise HTTPException(status_code=500, detail=f"Error al sincronizar documento: {str(e)}")
+
 class ConsultaChat(BaseModel):
     pregunta: str
+    deadline_s: Optional[float] = Field(default=None, gt=0, le=DEADLINE_MAXIMO_S)  # Plazo máximo para la sentencia (por defecto DEADLINE_RESPUESTA_S)
+    sesion_id: Optional[str] = None  # Conversación creada con POST /chat/sesion
 
-@app.post("/chat", summary="Consulta al chatbot usando contexto de documentos")
-async def consultar_chat(req: ConsultaChat):
-    try:
-        # Verificar si la colección existe
-        collections = qdrant_client.get_collections().collections
-        collection_names = [collection.name for collection in collections]
-        
-        if COLLECTION_NAME not in collection_names:
-            raise HTTPException(
-                status_code=404, 
-                detail=f"La colección {COLLECTION_NAME} no existe. Por favor, sube un documento primero."
-            )
-            
-        # Obtener el conteo de puntos en la colección
-        collection_info = qdrant_client.get_collection(COLLECTION_NAME)
-        if collection_info.points_count == 0:
-            raise HTTPException(
-                status_code=404, 
-                detail=f"La colección {COLLECTION_NAME} está vacía. Por favor, sube un documento primero."
-            )
-            
-        # Codificar la pregunta
-        vector_pregunta = model_embeddings.encode([req.pregunta])[0]
-        
-        # Buscar contexto relevante con más resultados para documentos grandes
-        try:
-            resultados = qdrant_client.search(
-                collection_name=COLLECTION_NAME,
-                query_vector=vector_pregunta,
-                limit=8,  # Aumentado para mejor cobertura de documentos grandes
-                score_threshold=MIN_SIMILARITY_THRESHOLD
-            )
-        except Exception as e:
-            print(f"Error al buscar en Qdrant: {str(e)}")
-            raise HTTPException(status_code=500, detail=f"Error al buscar información: {str(e)}")
-        
-        # Verificar si hay resultados relevantes
-        if not resultados or (resultados and resultados[0].score < MIN_SIMILARITY_THRESHOLD):
-            # No hay contexto relevante, usar conocimiento general de IA
-            prompt = construir_prompt("", req.pregunta, documento_actual, tiene_contexto_relevante=False)
-            texto_respuesta = generar_respuesta_openai(prompt, req.pregunta, OPENAI_MODEL)
-            
-            # Guardar en Excel con indicación de respuesta basada en IA
-            guardar_en_excel(f"[SIN CONTEXTO DOC] {req.pregunta}", texto_respuesta)
-            
-            return {"respuesta": texto_respuesta, "fuente": "conocimiento_ia", "modelo_usado": OPENAI_MODEL}
-            
-        # Hay contexto relevante, construir respuesta basada en documento
-        contexto_combinado = []
-        for resultado in resultados:
-            contexto_combinado.append(f"[Relevancia: {resultado.score:.3f}] {resultado.payload['text']}")
-        
-        contexto = "\n\n".join(contexto_combinado)
-        prompt = construir_prompt(contexto, req.pregunta, documento_actual, tiene_contexto_relevante=True)
+class ConsultaLote(BaseModel):
+    preguntas: List[str]
+    stream: bool = False  # Enviar cada resultado (NDJSON) en cuanto termina
+    deadline_s: Optional[float] = Field(default=None, gt=0, le=DEADLINE_MAXIMO_S)  # Plazo máximo por sentencia
 
-        # Generar respuesta
-        texto_respuesta = generar_respuesta_openai(prompt, req.pregunta, OPENAI_MODEL)
+def verificar_coleccion_disponible():
+    """
+    Lanza HTTPException 404 si la colección no existe o está vacía
+    """
+    collections = consultar_qdrant(qdrant_client.get_collections).collections
+    collection_names = [collection.name for collection in collections]
 
-        # Agregar información sobre las fuentes consultadas
-        num_fragmentos = len(resultados)
-        max_score = max([r.score for r in resultados])
-        min_score = min([r.score for r in resultados])
-        
-        info_fuentes = f"\n\n📚 **Información de consulta:**\n- Documento: {documento_actual.get('descripcion', 'Documento Legal')}\n- Especialidad: {documento_actual.get('especialidad', 'Derecho General')}\n- Fragmentos consultados: {num_fragmentos}\n- Relevancia máxima: {max_score:.3f}\n- Relevancia mínima: {min_score:.3f}"
-        texto_respuesta += info_fuentes
+    if COLLECTION_NAME not in collection_names:
+        raise HTTPException(
+            status_code=404, 
+            detail=f"La colección {COLLECTION_NAME} no existe. Por favor, sube un documento primero."
+        )
 
-        # Guardar pregunta y respuesta en Excel
-        guardar_en_excel(req.pregunta, texto_respuesta)
+    # Obtener el conteo de puntos en la colección
+    collection_info = consultar_qdrant(qdrant_client.get_collection, COLLECTION_NAME)
+    if collection_info.points_count == 0:
+        raise HTTPException(
+            status_code=404, 
+            detail=f"La colección {COLLECTION_NAME} está vacía. Por favor, sube un documento primero."
+        )
 
+def respuesta_openai_no_disponible(pregunta: str, vector_pregunta=None, info_articulos: dict = None) -> dict:
+    """
+    Respuesta inmediata con el circuito de OpenAI abierto: la de una pregunta casi idéntica
+    de la caché semántica o, si no hay, un aviso de servicio no disponible
+    """
+    degradacion = {"degradado": True, "motivo_degradacion": "openai_no_disponible"}
+    encontrada = buscar_en_cache_semantico(vector_pregunta)
+    if encontrada:
+        pregunta_cache, respuesta_cache, similitud = encontrada
+        guardar_en_excel(f"[CACHÉ SEMÁNTICA] {pregunta}", respuesta_cache["respuesta"])
         return {
-            "respuesta": texto_respuesta, 
-            "fuente": "documento",
-            "documento_tipo": documento_actual.get('tipo'),
-            "documento_especialidad": documento_actual.get('especialidad'),
-            "fragmentos_consultados": num_fragmentos,
-            "relevancia_maxima": max_score,
-            "modelo_usado": OPENAI_MODEL
+            **respuesta_cache,
+            **degradacion,
+            "fuente_degradacion": "cache_semantica",
+            "pregunta_cache": pregunta_cache,
+            "similitud_cache": round(similitud, 4)
         }
 
+    return {
+        "respuesta": sentencia_error(mensaje_error_openai(CircuitoAbierto())),
+        "fuente": "sin_respuesta",
+        "modelo_usado": None,
+        "motivo_modelo": "circuito_abierto",
+        **degradacion,
+        **(info_articulos or {})
+    }
+
+def documento_de_resultados(resultados) -> dict:
+    """
+    Tipo, especialidad y descripción de los documentos de donde salen los fragmentos recuperados
+    (ordenados por relevancia); sin esos campos en el payload se usa el documento actual
+    """
+    documento_actual = leer_documento_actual()
+    patrones = obtener_clasificador()["patrones"]
+    documentos = {}
+    for resultado in sorted(resultados, key=lambda r: r.score, reverse=True):
+        tipo = resultado.payload.get("documento_tipo") or documento_actual.get("tipo")
+        if tipo not in documentos:
+            especialidad = resultado.payload.get("documento_especialidad") or documento_actual.get("especialidad")
+            descripcion = patrones.get(tipo, {}).get("descripcion") or documento_actual.get("descripcion")
+            documentos[tipo] = {"tipo": tipo, "especialidad": especialidad, "descripcion": descripcion}
+    if not documentos:
+        return documento_actual
+
+    def unir(campo):
+        return " y ".join(dict.fromkeys(doc[campo] for doc in documentos.values() if doc[campo])) or None
+
+    return {"tipo": unir("tipo"), "especialidad": unir("especialidad"), "descripcion": unir("descripcion")}
+
+def generar_respuesta_chat(pregunta: str, resultados, clasificacion_pregunta: dict, deadline_s: float = None,
+                           info_articulos: dict = None, historial: str = "", cancelacion: threading.Event = None,
+                           vector_pregunta=None) -> dict:
+    """
+    Construye el prompt con los resultados de búsqueda, genera la sentencia y la registra en Excel
+    """
+    # OpenAI marcado como caído: responder al instante en vez de esperar un error
+    if circuito_openai.abierto():
+        circuito_openai.rechazar()
+        return respuesta_openai_no_disponible(pregunta, vector_pregunta, info_articulos)
+
+    documento_actual = leer_documento_actual()
+    modelo = leer_modelo_actual()
+
+    # Verificar si hay resultados relevantes
+    if not resultados or (resultados and resultados[0].score < MIN_SIMILARITY_THRESHOLD):
+        # No hay contexto relevante, usar conocimiento general de IA
+        prompt = construir_prompt("", pregunta, documento_actual, tiene_contexto_relevante=False, historial=historial)
+        texto_respuesta, info_modelo = generar_respuesta_con_respaldo(prompt, pregunta, modelo, deadline_s, cancelacion)
+        verificar_cancelacion(cancelacion)
+
+        # Guardar en Excel con indicación de respuesta basada en IA
+        guardar_en_excel(f"[SIN CONTEXTO DOC] {pregunta}", texto_respuesta)
+
+        respuesta = {"respuesta": texto_respuesta, "fuente": "conocimiento_ia", **info_modelo, **(info_articulos or {})}
+        # Las respuestas construidas con el historial de una sesión no se comparten con otros usuarios
+        if info_modelo["modelo_usado"] and not historial:
+            guardar_en_cache_semantico(vector_pregunta, pregunta, respuesta)
+        return respuesta
+
+    # Hay contexto relevante, empaquetar fragmentos según el presupuesto de tokens del modelo.
+    # El juez y el código citado son los de los fragmentos recuperados, no el último PDF subido
+    documento_consultado = documento_de_resultados(resultados)
+    contexto, info_contexto = empaquetar_contexto(resultados, modelo)
+    prompt = construir_prompt(contexto, pregunta, documento_consultado, tiene_contexto_relevante=True, historial=historial)
+
+    # Generar respuesta (con modelo de respaldo si el principal no responde a tiempo)
+    texto_respuesta, info_modelo = generar_respuesta_con_respaldo(prompt, pregunta, modelo, deadline_s, cancelacion)
+    verificar_cancelacion(cancelacion)
+
+    # Agregar información sobre las fuentes consultadas
+    num_fragmentos = info_contexto["fragmentos_usados"]
+    # La relevancia se calcula solo con los resultados vectoriales; las citas directas se cuentan aparte
+    scores_vectoriales = [r.score for r in resultados if not r.payload.get("cita_directa")]
+    num_citas_directas = len(resultados) - len(scores_vectoriales)
+    max_score = max(scores_vectoriales) if scores_vectoriales else None
+    min_score = min(scores_vectoriales) if scores_vectoriales else None
+
+    info_fuentes = f"\n\n📚 **Información de consulta:**\n- Documento: {documento_consultado.get('descripcion') or 'Documento Legal'}\n- Especialidad: {documento_consultado.get('especialidad') or 'Derecho General'}\n- Fragmentos consultados: {num_fragmentos}"
+    if num_citas_directas:
+        info_fuentes += f"\n- Fragmentos de artículos citados: {num_citas_directas}"
+    if scores_vectoriales:
+        info_fuentes += f"\n- Relevancia máxima: {max_score:.3f}\n- Relevancia mínima: {min_score:.3f}"
+    texto_respuesta += info_fuentes
+
+    # Guardar pregunta y respuesta en Excel
+    guardar_en_excel(pregunta, texto_respuesta)
+
+    respuesta = {
+        "respuesta": texto_respuesta,
+        "fuente": "documento",
+        "documento_tipo": documento_consultado.get('tipo'),
+        "documento_especialidad": documento_consultado.get('especialidad'),
+        "fragmentos_consultados": num_fragmentos,
+        "relevancia_maxima": max_score,
+        "tokens_contexto": info_contexto["tokens_contexto"],
+        "presupuesto_tokens": info_contexto["presupuesto_tokens"],
+        "bloques_contexto": info_contexto["bloques_contexto"],
+        "especialidad_pregunta": clasificacion_pregunta.get("especialidad"),
+        **info_modelo,
+        **(info_articulos or {})
+    }
+    if info_modelo["modelo_usado"] and not historial:
+        guardar_en_cache_semantico(vector_pregunta, pregunta, respuesta)
+    return respuesta
+
+def verificar_cancelacion(cancelacion: threading.Event = None):
+    if cancelacion is not None and cancelacion.is_set():
+        raise SolicitudCancelada("Cliente desconectado")
+
+async def vigilar_desconexion(request: Request, cancelacion: threading.Event, aguardable):
+    """
+    Espera el resultado mientras comprueba si el cliente sigue conectado. Si se desconecta,
+    activa la cancelación (los hilos cierran sus llamadas pendientes y no registran nada)
+    """
+    tarea = asyncio.ensure_future(aguardable)
+    try:
+        while True:
+            terminadas, _ = await asyncio.wait({tarea}, timeout=INTERVALO_CANCELACION_S)
+            if terminadas:
+                return tarea.result()
+            if await request.is_disconnected():
+                gobernador_openai.incrementar("solicitudes_canceladas")
+                raise SolicitudCancelada("Cliente desconectado")
+    finally:
+        if not tarea.done():
+            cancelacion.set()
+            tarea.cancel()
+
+def procesar_consulta(pregunta: str, historial: str, deadline_s: float, cancelacion: threading.Event) -> dict:
+    """
+    Pipeline de /chat (búsqueda + generación); entre etapas se comprueba la cancelación.
+    Con el circuito de Qdrant abierto se responde sin contexto de documentos.
+    """
+    qdrant_disponible = True
+    try:
+        # Verificar que la colección existe y tiene puntos
+        verificar_coleccion_disponible()
+    except CircuitoAbierto:
+        qdrant_disponible = False
+
+    # Clasificar la pregunta para informar la especialidad consultada
+    clasificacion_pregunta = clasificar_pregunta(pregunta)
+
+    # Codificar la pregunta junto con los antecedentes de la sesión
+    texto_busqueda = f"{pregunta}\n{historial}" if historial else pregunta
+    vector_pregunta = model_embeddings.encode([texto_busqueda])[0]
+    verificar_cancelacion(cancelacion)
+
+    # Buscar contexto relevante solo en las especialidades de la pregunta (global si no hay confianza)
+    ruta = enrutar_pregunta(pregunta, clasificacion_pregunta)
+    resultados, info_articulos = [], {}
+    try:
+        if qdrant_disponible:
+            resultados = buscar_contexto_enrutado(vector_pregunta, ruta)
+
+            # Artículos citados explícitamente: lectura directa del índice, antes que la similitud
+            directos, info_articulos = buscar_articulos_citados(pregunta)
+            resultados = combinar_resultados(directos, resultados)
+    except CircuitoAbierto:
+        qdrant_disponible = False
+    except Exception as e:
+        print(f"Error al buscar en Qdrant: {str(e)}")
+        raise HTTPException(status_code=500, detail=f"Error al buscar información: {str(e)}")
+    verificar_cancelacion(cancelacion)
+
+    respuesta = generar_respuesta_chat(
+        pregunta, resultados, clasificacion_pregunta, deadline_s, info_articulos, historial, cancelacion,
+        vector_pregunta=vector_pregunta
+    )
+    respuesta["enrutamiento"] = ruta
+    if not qdrant_disponible:
+        respuesta.update({"degradado": True, "motivo_degradacion": "qdrant_no_disponible"})
+    return respuesta
+
+@app.post("/chat", summary="Consulta al chatbot usando contexto de documentos")
+async def consultar_chat(req: ConsultaChat, request: Request, background_tasks: BackgroundTasks):
+    cancelacion = threading.Event()
+    try:
+        # Antecedentes de la sesión (resumen acotado + últimos turnos)
+        historial = ""
+        if req.sesion_id:
+            sesion = leer_sesion(req.sesion_id)
+            if sesion is None:
+                raise HTTPException(status_code=404, detail="La sesión no existe o expiró. Crea una nueva con POST /chat/sesion.")
+            historial = historial_sesion(sesion)
+
+        # Ejecutar en un hilo (la cola de OpenAI no bloquea el event loop) vigilando la desconexión
+        respuesta = await vigilar_desconexion(
+            request,
+            cancelacion,
+            asyncio.to_thread(procesar_consulta, req.pregunta, historial, req.deadline_s, cancelacion)
+        )
+
+        if req.sesion_id:
+            # El turno se guarda antes de responder; solo el resumen se actualiza en segundo plano
+            sesion = agregar_turno(req.sesion_id, req.pregunta, respuesta["respuesta"])
+            if sesion and len(sesion["turnos"]) > SESION_TURNOS_RECIENTES:
+                background_tasks.add_task(plegar_sesion, req.sesion_id)
+            respuesta["sesion_id"] = req.sesion_id
+            respuesta["tokens_historial"] = contar_tokens(historial)
+
+        return respuesta
+
+    except SolicitudCancelada:
+        print("Solicitud /chat cancelada: el cliente se desconectó")
+        raise HTTPException(status_code=499, detail="Solicitud cancelada: el cliente se desconectó")
     except HTTPException as he:
         # Re-lanzar excepciones HTTP
         raise he
@@ -532,46 +2090,132 @@ async def consultar_chat(req: ConsultaChat):
         print(f"Error detallado: {error_detalle}")
         raise HTTPException(status_code=500, detail=f"Error al generar respuesta: {str(e)}")
 
+@app.post("/chat/sesion", summary="Crear una sesión de conversación")
+async def crear_sesion_chat():
+    return {"sesion_id": crear_sesion(), "ttl_s": SESION_TTL_S}
+
+@app.get("/chat/sesion/{sesion_id}", summary="Ver resumen e historial reciente de una sesión")
+async def obtener_sesion_chat(sesion_id: str):
+    sesion = leer_sesion(sesion_id)
+    if sesion is None:
+        raise HTTPException(status_code=404, detail="La sesión no existe o expiró")
+    return {"sesion_id": sesion_id, **sesion}
+
+@app.delete("/chat/sesion/{sesion_id}", summary="Cerrar una sesión de conversación")
+async def cerrar_sesion_chat(sesion_id: str):
+    borrar_sesion(sesion_id)
+    return {"estado": "ok", "mensaje": f"Sesión {sesion_id} cerrada"}
+
+@app.post("/chat/lote", summary="Consulta por lotes: varias preguntas en una sola llamada")
+async def consultar_chat_lote(req: ConsultaLote, request: Request):
+    if not req.preguntas:
+        raise HTTPException(status_code=400, detail="Debe enviar al menos una pregunta")
+    if len(req.preguntas) > MAX_PREGUNTAS_LOTE:
+        raise HTTPException(status_code=400, detail=f"Máximo {MAX_PREGUNTAS_LOTE} preguntas por lote")
+
+    # Una sola codificación y una sola búsqueda por lotes para todas las preguntas,
+    # cada una filtrada a los shards de sus especialidades. Todo es bloqueante (CPU y red):
+    # se ejecuta en hilos para no detener el event loop con lotes grandes
+    def preparar_lote():
+        clasificaciones = [clasificar_pregunta(pregunta) for pregunta in req.preguntas]
+        rutas = [enrutar_pregunta(pregunta, clasificacion) for pregunta, clasificacion in zip(req.preguntas, clasificaciones)]
+        return clasificaciones, rutas, model_embeddings.encode(req.preguntas)
+
+    clasificaciones, rutas, vectores = await asyncio.to_thread(preparar_lote)
+
+    try:
+        await asyncio.to_thread(verificar_coleccion_disponible)
+        resultados_lote = await asyncio.to_thread(buscar_lote_enrutado, vectores, rutas)
+        qdrant_disponible = True
+    except CircuitoAbierto:
+        # Qdrant marcado como caído: todas las preguntas se responden sin contexto
+        resultados_lote = [[] for _ in req.preguntas]
+        qdrant_disponible = False
+    except HTTPException:
+        raise
+    except Exception as e:
+        print(f"Error al buscar lote en Qdrant: {str(e)}")
+        raise HTTPException(status_code=500, detail=f"Error al buscar información: {str(e)}")
+
+    # Generaciones concurrentes acotadas por semáforo; los errores se reportan por pregunta
+    semaforo = asyncio.Semaphore(MAX_GENERACIONES_CONCURRENTES)
+    cancelacion = threading.Event()
+
+    async def procesar(indice: int, pregunta: str, resultados) -> dict:
+        async with semaforo:
+            try:
+                verificar_cancelacion(cancelacion)
+                clasificacion_pregunta = clasificaciones[indice]
+                info_articulos = {}
+                if qdrant_disponible:
+                    directos, info_articulos = await asyncio.to_thread(buscar_articulos_citados, pregunta)
+                    resultados = combinar_resultados(directos, resultados)
+                respuesta = await asyncio.to_thread(
+                    generar_respuesta_chat, pregunta, resultados, clasificacion_pregunta, req.deadline_s, info_articulos, "", cancelacion,
+                    vector_pregunta=vectores[indice]
+                )
+                if not qdrant_disponible:
+                    respuesta.update({"degradado": True, "motivo_degradacion": "qdrant_no_disponible"})
+                return {"indice": indice, "pregunta": pregunta, "estado": "ok", **respuesta, "enrutamiento": rutas[indice]}
+            except SolicitudCancelada:
+                return {"indice": indice, "pregunta": pregunta, "estado": "cancelada"}
+            except Exception as e:
+                print(f"Error en pregunta {indice} del lote: {str(e)}")
+                return {"indice": indice, "pregunta": pregunta, "estado": "error", "error": str(e)}
+
+    tareas = [
+        asyncio.create_task(procesar(indice, pregunta, resultados))
+        for indice, (pregunta, resultados) in enumerate(zip(req.preguntas, resultados_lote))
+    ]
+
+    if req.stream:
+        async def emitir():
+            try:
+                for tarea in asyncio.as_completed(tareas):
+                    yield json.dumps(await tarea, ensure_ascii=False) + "\n"
+            finally:
+                # Si el cliente corta el stream se abandonan las preguntas pendientes
+                if not all(tarea.done() for tarea in tareas):
+                    gobernador_openai.incrementar("solicitudes_canceladas")
+                    cancelacion.set()
+                    for tarea in tareas:
+                        tarea.cancel()
+
+        return StreamingResponse(emitir(), media_type="application/x-ndjson")
+
+    try:
+        resultados_finales = await vigilar_desconexion(request, cancelacion, asyncio.gather(*tareas))
+    except SolicitudCancelada:
+        print("Solicitud /chat/lote cancelada: el cliente se desconectó")
+        raise HTTPException(status_code=499, detail="Solicitud cancelada: el cliente se desconectó")
+    return {
+        "estado": "ok",
+        "total_preguntas": len(resultados_finales),
+        "exitosas": sum(1 for r in resultados_finales if r["estado"] == "ok"),
+        "con_error": sum(1 for r in resultados_finales if r["estado"] == "error"),
+        "resultados": resultados_finales
+    }
+
 # Obtener estadísticas del documento cargado
 @app.get("/documento/estadisticas", summary="Obtener estadísticas del documento cargado")
-async def obtener_estadisticas_documento():
+async def obtener_estadisticas_documento(detalle: bool = False):
     try:
-        # Verificar si la colección existe
-        collections = qdrant_client.get_collections().collections
-        collection_names = [collection.name for collection in collections]
-        
-        if COLLECTION_NAME not in collection_names:
+        # Estadísticas calculadas en la ingesta: lectura local, sin consultar Qdrant
+        corpus = leer_estado("estadisticas_corpus")
+        if not corpus:
             return {
                 "estado": "sin_documento",
                 "mensaje": "No hay documento cargado"
             }
-            
-        # Obtener información de la colección
-        collection_info = qdrant_client.get_collection(COLLECTION_NAME)
-        
-        if collection_info.points_count == 0:
-            return {
-                "estado": "coleccion_vacia",
-                "mensaje": "La colección existe pero está vacía"
-            }
-        
-        # Obtener algunos puntos de muestra para estadísticas
-        puntos_muestra = qdrant_client.scroll(
-            collection_name=COLLECTION_NAME,
-            limit=10,
-            with_payload=True
-        )[0]
-        
-        # Calcular estadísticas básicas
-        longitudes_texto = [len(punto.payload.get("text", "")) for punto in puntos_muestra]
-        longitud_promedio = sum(longitudes_texto) / len(longitudes_texto) if longitudes_texto else 0
-        
-        return {
+
+        documento_actual = leer_documento_actual()
+        respuesta = {
             "estado": "documento_cargado",
-            "total_fragmentos": collection_info.points_count,
-            "longitud_promedio_fragmento": round(longitud_promedio, 2),
-            "longitud_minima_muestra": min(longitudes_texto) if longitudes_texto else 0,
-            "longitud_maxima_muestra": max(longitudes_texto) if longitudes_texto else 0,
+            "total_fragmentos": corpus["total_fragmentos"],
+            "longitud_promedio_fragmento": corpus["longitud_promedio"],
+            "longitud_minima_fragmento": corpus["longitud_minima"],
+            "longitud_maxima_fragmento": corpus["longitud_maxima"],
+            "estadisticas_corpus": corpus,
             "documento_actual": {
                 "tipo": documento_actual.get('tipo'),
                 "especialidad": documento_actual.get('especialidad'),
@@ -585,6 +2229,15 @@ async def obtener_estadisticas_documento():
                 "umbral_similitud": MIN_SIMILARITY_THRESHOLD
             }
         }
+
+        # Conteos por página y por artículo de cada documento (respuesta más grande)
+        if detalle:
+            respuesta["detalle_documentos"] = {
+                clave.split(":", 1)[1]: {k: v for k, v in stats.items() if k != "hashes"}
+                for clave, stats in listar_estado("estadisticas_documento:").items()
+            }
+
+        return respuesta
         
     except Exception as e:
         return {
@@ -600,7 +2253,10 @@ async def limpiar_coleccion():
         collection_names = [collection.name for collection in collections]
         
         if COLLECTION_NAME in collection_names:
-            qdrant_client.delete_collection(COLLECTION_NAME)
+            qdrant_client_carga.delete_collection(COLLECTION_NAME)
+            eliminar_estadisticas_documento()
+            borrar_estado("indice_articulos")
+            borrar_estado("siguiente_id_punto")
             return {
                 "estado": "ok",
                 "mensaje": f"Colección {COLLECTION_NAME} eliminada exitosamente"
@@ -613,6 +2269,212 @@ async def limpiar_coleccion():
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Error al limpiar colección: {str(e)}")
 
+@app.get("/busqueda/enrutamiento", summary="Métricas del enrutamiento de preguntas por especialidad")
+async def obtener_metricas_enrutamiento():
+    corpus = leer_estado("estadisticas_corpus") or {}
+    return {
+        "umbral_confianza_ruteo": UMBRAL_CONFIANZA_RUTEO,
+        "fragmentos_por_especialidad": corpus.get("fragmentos_por_especialidad", {}),
+        "metricas": resumen_enrutamiento()
+    }
+
+# === Snapshots de la colección ===
+# Formato: carpeta con vectores.npy (float32, memory-mappable), ids.npy, payloads.json
+# (columnar: una lista por campo) y manifest.json con la configuración y el estado del documento
+def ruta_snapshot(nombre: str) -> str:
+    if not re.fullmatch(r"[\w.-]+", nombre) or nombre.startswith("."):
+        raise HTTPException(status_code=400, detail="Nombre de snapshot no válido")
+    return os.path.join(SNAPSHOT_FOLDER, nombre)
+
+def redimensionar_matriz_npy(ruta: str, filas_usadas: int, filas_nuevas: int):
+    """
+    Copia las filas usadas de un .npy a otro de filas_nuevas filas (por tramos) y lo reemplaza.
+    Quien llama debe cerrar antes su memmap del archivo; devuelve uno nuevo en modo r+.
+    """
+    matriz = np.load(ruta, mmap_mode="r")
+    ruta_nueva = ruta + ".redim.npy"
+    nueva = np.lib.format.open_memmap(ruta_nueva, mode="w+", dtype=matriz.dtype, shape=(filas_nuevas,) + matriz.shape[1:])
+    for inicio in range(0, filas_usadas, SNAPSHOT_BATCH_SIZE):
+        fin = min(inicio + SNAPSHOT_BATCH_SIZE, filas_usadas)
+        nueva[inicio:fin] = matriz[inicio:fin]
+    nueva.flush()
+    del matriz, nueva
+    os.replace(ruta_nueva, ruta)
+    return np.lib.format.open_memmap(ruta, mode="r+")
+
+def exportar_snapshot(nombre: str) -> dict:
+    """
+    Escribe chunks, payloads y la matriz de vectores de la colección en un snapshot compacto
+    """
+    inicio = time.monotonic()
+    ruta = ruta_snapshot(nombre)
+    # points_count de get_collection es aproximado: el tamaño inicial sale de un conteo exacto
+    total = qdrant_client.count(COLLECTION_NAME, exact=True).count
+    if not total:
+        raise HTTPException(status_code=404, detail=f"La colección {COLLECTION_NAME} está vacía")
+
+    # Escribir en carpeta temporal y renombrar al final para no dejar snapshots a medias
+    ruta_tmp = ruta + ".tmp"
+    shutil.rmtree(ruta_tmp, ignore_errors=True)
+    os.makedirs(ruta_tmp)
+
+    ruta_vectores = os.path.join(ruta_tmp, "vectores.npy")
+    capacidad = total
+    vectores = np.lib.format.open_memmap(ruta_vectores, mode="w+", dtype=np.float32, shape=(capacidad, MODEL_DIM))
+    ids = []
+    columnas = {}
+    fila = 0
+    offset = None
+    while True:
+        puntos, offset = qdrant_client_carga.scroll(
+            collection_name=COLLECTION_NAME,
+            limit=SNAPSHOT_BATCH_SIZE,
+            offset=offset,
+            with_payload=True,
+            with_vectors=True
+        )
+        for punto in puntos:
+            if fila >= capacidad:
+                # Llegaron puntos durante la exportación: ampliar la matriz en vez de descartarlos
+                capacidad = max(capacidad * 2, fila + len(puntos))
+                vectores.flush()
+                del vectores
+                vectores = redimensionar_matriz_npy(ruta_vectores, fila, capacidad)
+            vectores[fila] = punto.vector
+            ids.append(punto.id)
+            for campo in set(columnas) | set(punto.payload):
+                columnas.setdefault(campo, [None] * fila).append(punto.payload.get(campo))
+            fila += 1
+        if offset is None:
+            break
+    vectores.flush()
+    del vectores
+    if fila != capacidad:
+        redimensionar_matriz_npy(ruta_vectores, fila, fila)
+
+    np.save(os.path.join(ruta_tmp, "ids.npy"), np.array(ids, dtype=np.int64 if all(isinstance(i, int) for i in ids) else str))
+    with open(os.path.join(ruta_tmp, "payloads.json"), "w", encoding="utf-8") as f:
+        json.dump(columnas, f, ensure_ascii=False)
+
+    manifest = {
+        "coleccion": COLLECTION_NAME,
+        "puntos": fila,
+        "dimension": MODEL_DIM,
+        "distancia": "Cosine",
+        "modelo_embeddings": MODELO_EMBEDDINGS,
+        "documento_actual": leer_documento_actual(),
+        "estadisticas_documentos": listar_estado("estadisticas_documento:"),
+        "fecha": datetime.now().isoformat()
+    }
+    with open(os.path.join(ruta_tmp, "manifest.json"), "w", encoding="utf-8") as f:
+        json.dump(manifest, f, ensure_ascii=False)
+
+    shutil.rmtree(ruta, ignore_errors=True)
+    os.rename(ruta_tmp, ruta)
+
+    return {
+        "estado": "ok",
+        "snapshot": nombre,
+        "puntos": fila,
+        "tamaño_mb": round(sum(os.path.getsize(os.path.join(ruta, f)) for f in os.listdir(ruta)) / (1024 * 1024), 2),
+        "tiempo_s": round(time.monotonic() - inicio, 2)
+    }
+
+def importar_snapshot(nombre: str) -> dict:
+    """
+    Recrea la colección desde un snapshot por el camino de carga masiva, sin PDF ni modelo de embeddings
+    """
+    inicio = time.monotonic()
+    ruta = ruta_snapshot(nombre)
+    if not os.path.exists(os.path.join(ruta, "manifest.json")):
+        raise HTTPException(status_code=404, detail=f"No existe el snapshot {nombre}")
+
+    with open(os.path.join(ruta, "manifest.json"), "r", encoding="utf-8") as f:
+        manifest = json.load(f)
+    if manifest["dimension"] != MODEL_DIM:
+        raise HTTPException(status_code=400, detail=f"Dimensión del snapshot ({manifest['dimension']}) distinta a la del modelo ({MODEL_DIM})")
+
+    vectores = np.load(os.path.join(ruta, "vectores.npy"), mmap_mode="r")
+    ids = np.load(os.path.join(ruta, "ids.npy")).tolist()
+    with open(os.path.join(ruta, "payloads.json"), "r", encoding="utf-8") as f:
+        columnas = json.load(f)
+
+    payloads = (
+        {campo: valores[i] for campo, valores in columnas.items() if valores[i] is not None}
+        for i in range(len(ids))
+    )
+
+    inicializar_qdrant()
+    qdrant_client_carga.upload_collection(
+        collection_name=COLLECTION_NAME,
+        vectors=vectores,
+        payload=payloads,
+        ids=ids,
+        batch_size=SNAPSHOT_BATCH_SIZE,
+        parallel=SNAPSHOT_PARALELO,
+        wait=True
+    )
+
+    # Restaurar el estado del documento y sus estadísticas
+    guardar_estado("documento_actual", manifest["documento_actual"])
+    eliminar_estadisticas_documento()
+    for clave, estadisticas in manifest.get("estadisticas_documentos", {}).items():
+        guardar_estado(clave, estadisticas)
+    recalcular_totales_corpus()
+
+    # Reconstruir el índice de artículos desde los payloads restaurados
+    indice = {}
+    for id_punto, tipo, articulos in zip(ids, columnas.get("documento_tipo", []), columnas.get("articulos", [])):
+        for articulo in articulos or []:
+            indice.setdefault(tipo, {}).setdefault(articulo, []).append(id_punto)
+    registrar_indice_articulos(indice)
+    guardar_estado("siguiente_id_punto", max(ids, default=-1) + 1 if all(isinstance(i, int) for i in ids) else len(ids))
+
+    return {
+        "estado": "ok",
+        "snapshot": nombre,
+        "puntos_restaurados": len(ids),
+        "documento": manifest["documento_actual"].get("filename"),
+        "tiempo_s": round(time.monotonic() - inicio, 2)
+    }
+
+class SnapshotConfig(BaseModel):
+    nombre: str
+
+@app.post("/documento/snapshot/exportar", summary="Exportar la colección a un snapshot en disco")
+async def exportar_snapshot_endpoint(req: SnapshotConfig):
+    try:
+        return await asyncio.to_thread(exportar_snapshot, req.nombre)
+    except HTTPException:
+        raise
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Error al exportar snapshot: {str(e)}")
+
+@app.post("/documento/snapshot/importar", summary="Reconstruir la colección desde un snapshot en disco")
+async def importar_snapshot_endpoint(req: SnapshotConfig):
+    try:
+        return await asyncio.to_thread(importar_snapshot, req.nombre)
+    except HTTPException:
+        raise
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Error al importar snapshot: {str(e)}")
+
+@app.get("/documento/snapshots", summary="Listar snapshots disponibles")
+async def listar_snapshots():
+    snapshots = []
+    for nombre in sorted(os.listdir(SNAPSHOT_FOLDER)):
+        manifest_path = os.path.join(SNAPSHOT_FOLDER, nombre, "manifest.json")
+        if os.path.exists(manifest_path):
+            with open(manifest_path, "r", encoding="utf-8") as f:
+                manifest = json.load(f)
+            snapshots.append({
+                "nombre": nombre,
+                "puntos": manifest["puntos"],
+                "documento": manifest["documento_actual"].get("filename"),
+                "fecha": manifest["fecha"]
+            })
+    return {"snapshots": snapshots}
+
 # Verificar conectividad con Qdrant
 @app.get("/qdrant/test", summary="Verificar conectividad con Qdrant")
 async def test_qdrant():
@@ -651,6 +2513,7 @@ async def test_qdrant():
 # Obtener información del documento actual
 @app.get("/documento/info", summary="Obtener información del documento actualmente cargado")
 async def obtener_info_documento():
+    documento_actual = leer_documento_actual()
     if not documento_actual.get('tipo'):
         return {
             "estado": "sin_documento",
@@ -662,53 +2525,365 @@ async def obtener_info_documento():
         "documento": documento_actual
     }
 
-# Función para generar respuestas con OpenAI
-def generar_respuesta_openai(prompt: str, pregunta: str = "", modelo: str = "gpt-3.5-turbo") -> str:
+# === Gobernador de concurrencia de OpenAI ===
+class LlamadaAbandonada(Exception):
+    """Quien pidió la llamada ya no espera el resultado (desconexión, plazo o hedging)"""
+
+def _conexion_cupos() -> sqlite3.Connection:
+    # Base aparte: las escrituras de cada llamada no invalidan la caché del estado
+    conexion = getattr(estado_local, "conexion_cupos", None)
+    if conexion is None:
+        conexion = sqlite3.connect(CUPOS_DB_PATH, timeout=5)
+        conexion.execute("PRAGMA journal_mode=WAL")
+        conexion.execute(
+            "CREATE TABLE IF NOT EXISTS cubetas (modelo TEXT PRIMARY KEY, peticiones REAL NOT NULL, tokens REAL NOT NULL, "
+            "actualizado REAL NOT NULL, bloqueado_hasta REAL NOT NULL)"
+        )
+        conexion.commit()
+        estado_local.conexion_cupos = conexion
+    return conexion
+
+class GobernadorOpenAI:
     """
-    Genera una respuesta usando la API de OpenAI con formato de sentencia
-    Modelos disponibles: gpt-3.5-turbo, gpt-4, gpt-4-turbo-preview
+    Limita las llamadas a OpenAI por modelo con cubetas de peticiones y tokens por minuto,
+    atiende la cola de cada modelo en orden de llegada y comparte una sola llamada entre
+    prompts idénticos que llegan al mismo tiempo. Las cubetas viven en SQLite (CUPOS_DB_PATH)
+    para que varios workers no multipliquen los límites de la cuenta.
     """
-    try:
-        client = openai.OpenAI(api_key=config["OPENAI_API_KEY"])
-        
-        # Configuraciones según el modelo
-        max_tokens = 3000 if "gpt-4" in modelo else 2000
-        
-        response = client.chat.completions.create(
-            model=modelo,
-            messages=[
-                {
-                    "role": "system", 
-                    "content": "Eres un juez especializado en derecho ecuatoriano. Siempre debes responder con el formato estructurado de una sentencia judicial, incluyendo fecha, razón, veredicto, lugar de reclusión y conclusión. Sé preciso en las citas legales y mantén la imparcialidad judicial."
-                },
-                {
-                    "role": "user", 
-                    "content": prompt
+    def __init__(self):
+        self.condicion = threading.Condition()
+        self.colas = {}
+        self.lock_en_vuelo = threading.Lock()
+        self.en_vuelo = {}
+        self.metricas = {
+            "llamadas_upstream": 0,
+            "llamadas_coalescidas": 0,
+            "reintentos_rate_limit": 0,
+            "esperas_en_cola": 0,
+            "espera_total_s": 0.0,
+            "espera_maxima_s": 0.0,
+            "solicitudes_canceladas": 0,
+            "generaciones_abortadas": 0,
+            "turnos_abandonados": 0,
+            "reintentos_tras_abandono": 0
+        }
+
+    def _limites(self, modelo: str):
+        rpm, tpm = LIMITES_OPENAI.get(modelo, LIMITES_OPENAI_DEFAULT)
+        return OPENAI_RPM or rpm, OPENAI_TPM or tpm
+
+    def _actualizar_cubeta(self, modelo: str, cambio=None):
+        """
+        Recarga la cubeta compartida del modelo según el tiempo transcurrido y aplica cambio(cubeta, ahora)
+        en una sola transacción: todos los workers consumen del mismo cupo de la cuenta.
+        Devuelve (cubeta, resultado de cambio).
+        """
+        rpm, tpm = self._limites(modelo)
+        conexion = _conexion_cupos()
+        ahora = time.time()
+        conexion.execute("BEGIN IMMEDIATE")
+        try:
+            fila = conexion.execute(
+                "SELECT peticiones, tokens, actualizado, bloqueado_hasta FROM cubetas WHERE modelo = ?", (modelo,)
+            ).fetchone()
+            peticiones, tokens, actualizado, bloqueado_hasta = fila or (float(rpm), float(tpm), ahora, 0.0)
+            transcurrido = max(0.0, ahora - actualizado)
+            cubeta = {
+                "rpm": rpm,
+                "tpm": tpm,
+                "peticiones": min(rpm, peticiones + transcurrido * rpm / 60),
+                "tokens": min(tpm, tokens + transcurrido * tpm / 60),
+                "bloqueado_hasta": bloqueado_hasta
+            }
+            resultado = cambio(cubeta, ahora) if cambio else None
+            conexion.execute(
+                "INSERT OR REPLACE INTO cubetas (modelo, peticiones, tokens, actualizado, bloqueado_hasta) VALUES (?, ?, ?, ?, ?)",
+                (modelo, cubeta["peticiones"], cubeta["tokens"], ahora, cubeta["bloqueado_hasta"])
+            )
+            conexion.commit()
+        except Exception:
+            conexion.rollback()
+            raise
+        return cubeta, resultado
+
+    def adquirir(self, modelo: str, tokens: int, abandonada=None):
+        """
+        Bloquea hasta que la petición es la primera de la cola del modelo (en este worker) y hay
+        capacidad en la cubeta compartida. Si abandonada() pasa a ser verdadero, el turno se retira
+        sin consumir cupo.
+        """
+        def tomar(cubeta, ahora):
+            tokens_necesarios = min(tokens, cubeta["tpm"])  # Una petición mayor que la cubeta nunca pasaría
+            faltan_peticiones = max(0.0, 1 - cubeta["peticiones"]) * 60 / cubeta["rpm"]
+            faltan_tokens = max(0.0, tokens_necesarios - cubeta["tokens"]) * 60 / cubeta["tpm"]
+            espera = max(faltan_peticiones, faltan_tokens, cubeta["bloqueado_hasta"] - ahora)
+            if espera <= 0:
+                cubeta["peticiones"] -= 1
+                cubeta["tokens"] -= tokens_necesarios
+            return espera
+
+        ticket = object()
+        inicio = time.monotonic()
+        # Con una señal de abandono las esperas se hacen por tramos para poder comprobarla
+        tramo = INTERVALO_CANCELACION_S if abandonada else None
+        with self.condicion:
+            cola = self.colas.setdefault(modelo, deque())
+            cola.append(ticket)
+            try:
+                while True:
+                    if abandonada and abandonada():
+                        with self.lock_en_vuelo:
+                            self.metricas["turnos_abandonados"] += 1
+                        raise LlamadaAbandonada(f"Turno en la cola de {modelo} abandonado")
+                    if cola[0] is ticket:
+                        _, espera = self._actualizar_cubeta(modelo, tomar)
+                        if espera <= 0:
+                            break
+                        self.condicion.wait(timeout=min(espera, tramo) if tramo else espera)
+                    else:
+                        self.condicion.wait(timeout=tramo)
+            finally:
+                cola.remove(ticket)
+                self.condicion.notify_all()
+
+        espera = time.monotonic() - inicio
+        with self.lock_en_vuelo:
+            self.metricas["esperas_en_cola"] += 1
+            self.metricas["espera_total_s"] += espera
+            self.metricas["espera_maxima_s"] = max(self.metricas["espera_maxima_s"], espera)
+
+    def ajustar_tokens(self, modelo: str, estimados: int, reales: int):
+        # Devolver a la cubeta los tokens reservados y no consumidos
+        def devolver(cubeta, ahora):
+            cubeta["tokens"] = min(cubeta["tpm"], cubeta["tokens"] + max(0, estimados - reales))
+
+        self._actualizar_cubeta(modelo, devolver)
+        with self.condicion:
+            self.condicion.notify_all()
+
+    def pausar(self, modelo: str, segundos: float):
+        # Tras un RateLimitError toda la cola del modelo espera (en todos los workers), no solo la petición rechazada
+        def bloquear(cubeta, ahora):
+            cubeta["bloqueado_hasta"] = max(cubeta["bloqueado_hasta"], ahora + segundos)
+
+        self._actualizar_cubeta(modelo, bloquear)
+        with self.condicion:
+            self.condicion.notify_all()
+
+    def _llamar(self, modelo: str, tokens_estimados: int, llamada, abandonada=None):
+        for intento in range(OPENAI_MAX_REINTENTOS + 1):
+            self.adquirir(modelo, tokens_estimados, abandonada)
+            try:
+                with self.lock_en_vuelo:
+                    self.metricas["llamadas_upstream"] += 1
+                response = llamada()
+            except openai.RateLimitError as e:
+                if intento == OPENAI_MAX_REINTENTOS:
+                    raise
+                espera = 2 ** intento
+                try:
+                    espera = float(e.response.headers.get("retry-after", espera))
+                except Exception:
+                    pass
+                print(f"Rate limit en {modelo}, reintento {intento + 1} en {espera:.1f}s")
+                with self.lock_en_vuelo:
+                    self.metricas["reintentos_rate_limit"] += 1
+                self.pausar(modelo, espera)
+                continue
+
+            usage = getattr(response, "usage", None)
+            if usage is not None and getattr(usage, "total_tokens", None):
+                self.ajustar_tokens(modelo, tokens_estimados, usage.total_tokens)
+            return response
+
+    def ejecutar(self, modelo: str, prompt: str, tokens_estimados: int, llamada, abandonada=None):
+        """
+        Ejecuta la llamada respetando los límites; las peticiones idénticas en vuelo comparten resultado.
+        abandonada() indica que quien llama ya no espera la respuesta (su llamada se canceló).
+        """
+        clave = hashlib.sha256(f"{modelo}\0{prompt}".encode("utf-8")).hexdigest()
+        while True:
+            with self.lock_en_vuelo:
+                futuro = self.en_vuelo.get(clave)
+                if futuro is not None:
+                    self.metricas["llamadas_coalescidas"] += 1
+                    lider = False
+                else:
+                    futuro = Future()
+                    self.en_vuelo[clave] = futuro
+                    lider = True
+
+            if lider:
+                break
+            try:
+                return self._esperar_lider(futuro, abandonada)
+            except LlamadaAbandonada:
+                if abandonada and abandonada():
+                    raise
+                # El líder se retiró a propósito: esta petición hace su propia llamada
+                with self.lock_en_vuelo:
+                    self.metricas["reintentos_tras_abandono"] += 1
+
+        try:
+            response = self._llamar(modelo, tokens_estimados, llamada, abandonada)
+        except BaseException as e:
+            self._liberar_en_vuelo(clave, futuro)
+            # Si el líder abandonó (su llamada se canceló), los seguidores no heredan ese error
+            futuro.set_exception(LlamadaAbandonada(str(e)) if abandonada and abandonada() else e)
+            raise
+        self._liberar_en_vuelo(clave, futuro)
+        futuro.set_result(response)
+        return response
+
+    def _liberar_en_vuelo(self, clave: str, futuro: Future):
+        with self.lock_en_vuelo:
+            if self.en_vuelo.get(clave) is futuro:
+                del self.en_vuelo[clave]
+
+    def _esperar_lider(self, futuro: Future, abandonada=None):
+        # Esperar por tramos para no retener el hilo si esta petición también se abandona
+        while True:
+            try:
+                return futuro.result(timeout=INTERVALO_CANCELACION_S if abandonada else None)
+            except FuturesTimeoutError:
+                if abandonada():
+                    raise LlamadaAbandonada("Petición abandonada mientras esperaba una llamada compartida")
+
+    def incrementar(self, metrica: str):
+        with self.lock_en_vuelo:
+            self.metricas[metrica] = self.metricas.get(metrica, 0) + 1
+
+    def estado(self) -> dict:
+        # Las cubetas son las compartidas por todos los workers; en_cola es la cola de este worker
+        usados = [fila[0] for fila in _conexion_cupos().execute("SELECT modelo FROM cubetas").fetchall()]
+        with self.condicion:
+            modelos = {}
+            for modelo in usados:
+                cubeta, _ = self._actualizar_cubeta(modelo)
+                modelos[modelo] = {
+                    "rpm": cubeta["rpm"],
+                    "tpm": cubeta["tpm"],
+                    "peticiones_disponibles": round(cubeta["peticiones"], 2),
+                    "tokens_disponibles": round(cubeta["tokens"]),
+                    "en_cola": len(self.colas.get(modelo, ()))
                 }
-            ],
-            max_tokens=max_tokens,
-            temperature=0.2,  # Más determinista para respuestas judiciales
-            top_p=0.95,
-            frequency_penalty=0.0,
-            presence_penalty=0.0
-        )
-        
-        respuesta = response.choices[0].message.content.strip()
-        
-        # Post-procesar para asegurar formato de sentencia
-        respuesta_formateada = post_procesar_sentencia(respuesta, pregunta)
-        
-        return respuesta_formateada
-        
-    except openai.AuthenticationError:
-        error_msg = "Error de autenticación con OpenAI. Verifica tu API key."
-    except openai.RateLimitError:
-        error_msg = "Límite de velocidad excedido en OpenAI. Intenta de nuevo en unos momentos."
-    except openai.APIError as e:
-        error_msg = f"Error de API de OpenAI: {str(e)}"
-    except Exception as e:
-        error_msg = f"Error al generar respuesta con OpenAI: {str(e)}"
-    
+        with self.lock_en_vuelo:
+            metricas = dict(self.metricas)
+            metricas["llamadas_en_vuelo"] = len(self.en_vuelo)
+        metricas["espera_promedio_s"] = round(metricas["espera_total_s"] / metricas["esperas_en_cola"], 4) if metricas["esperas_en_cola"] else 0.0
+        metricas["espera_total_s"] = round(metricas["espera_total_s"], 4)
+        metricas["espera_maxima_s"] = round(metricas["espera_maxima_s"], 4)
+        return {"metricas": metricas, "modelos": modelos}
+
+gobernador_openai = GobernadorOpenAI()
+
+@app.get("/openai/metricas", summary="Estado del limitador de llamadas a OpenAI")
+async def obtener_metricas_openai():
+    return {**gobernador_openai.estado(), "circuito": circuito_openai.estado()}
+
+# === Cliente OpenAI cancelable ===
+# Cerrar un openai.OpenAI no corta una petición en curso: el hilo sigue bloqueado y el servidor
+# termina (y cobra) la respuesta. Las llamadas se hacen con AsyncOpenAI en un event loop propio;
+# cancelar la tarea cierra la conexión HTTP y el upstream deja de generar.
+bucle_openai = asyncio.new_event_loop()
+threading.Thread(target=bucle_openai.run_forever, name="openai-loop", daemon=True).start()
+
+def crear_cliente_openai() -> openai.AsyncOpenAI:
+    # Sin reintentos del SDK: los gestiona el gobernador. OPENAI_BASE_URL permite apuntar a un servidor simulado
+    return openai.AsyncOpenAI(
+        api_key=config["OPENAI_API_KEY"],
+        base_url=OPENAI_BASE_URL or None,
+        max_retries=0
+    )
+
+async def completar_openai(**parametros):
+    async with crear_cliente_openai() as client:
+        return await client.chat.completions.create(**parametros)
+
+def esperar_completado(parametros: dict, abandonada=None):
+    """
+    Ejecuta la petición en el event loop de OpenAI y espera el resultado. Si abandonada() se
+    cumple, cancela la tarea (se corta la conexión) y lanza LlamadaAbandonada.
+    """
+    futuro = asyncio.run_coroutine_threadsafe(completar_openai(**parametros), bucle_openai)
+    while True:
+        try:
+            return futuro.result(timeout=INTERVALO_CANCELACION_S if abandonada else None)
+        except FuturesTimeoutError:
+            if abandonada():
+                futuro.cancel()
+                raise LlamadaAbandonada("Petición a OpenAI cancelada: quien llama ya no espera la respuesta")
+
+def llamar_openai(prompt: str, modelo: str, cancelacion: threading.Event = None, timeout: float = None,
+                  max_tokens: int = None, system_prompt: str = SYSTEM_PROMPT_JUEZ) -> str:
+    """
+    Realiza la llamada de chat a OpenAI a través del gobernador y devuelve el texto sin post-procesar.
+    Activar cancelacion aborta la petición, esté en cola o ya en curso.
+    """
+    abandonada = cancelacion.is_set if cancelacion is not None else None
+
+    # Configuraciones según el modelo
+    max_tokens = max_tokens or (3000 if "gpt-4" in modelo else 2000)
+    mensajes = [
+        {
+            "role": "system", 
+            "content": system_prompt
+        },
+        {
+            "role": "user", 
+            "content": prompt
+        }
+    ]
+
+    # La reserva en la cubeta de tokens incluye la salida máxima, como la cuenta OpenAI
+    tokens_estimados = contar_tokens(system_prompt + prompt, modelo) + max_tokens
+
+    def llamada():
+        # El circuito se evalúa en cada petición HTTP real (las coalescidas comparten el resultado)
+        circuito_openai.permitir()
+        try:
+            response = esperar_completado({
+                "model": modelo,
+                "messages": mensajes,
+                "max_tokens": max_tokens,
+                "temperature": 0.2,  # Más determinista para respuestas judiciales
+                "top_p": 0.95,
+                "frequency_penalty": 0.0,
+                "presence_penalty": 0.0,
+                "timeout": timeout
+            }, abandonada)
+        except Exception as e:
+            # Una llamada cancelada a propósito (perdedor del hedging, cliente desconectado) no es una caída
+            if es_fallo_openai(e) and not (abandonada and abandonada()):
+                circuito_openai.registrar_fallo(e)
+            else:
+                circuito_openai.liberar()
+            raise
+        circuito_openai.registrar_exito()
+        return response
+
+    # Fallo rápido antes de hacer cola si OpenAI está marcado como caído
+    if circuito_openai.abierto():
+        raise circuito_openai.rechazar()
+
+    response = gobernador_openai.ejecutar(modelo, prompt, tokens_estimados, llamada, abandonada=abandonada)
+    respuesta = response.choices[0].message.content
+    if not respuesta or not respuesta.strip():
+        raise ValueError(f"Respuesta vacía del modelo {modelo}")
+    return respuesta.strip()
+
+def mensaje_error_openai(e: Exception) -> str:
+    if isinstance(e, CircuitoAbierto):
+        return "El servicio de OpenAI no está disponible en este momento. Intenta de nuevo en unos momentos."
+    if isinstance(e, openai.AuthenticationError):
+        return "Error de autenticación con OpenAI. Verifica tu API key."
+    if isinstance(e, openai.RateLimitError):
+        return f"Límite de velocidad excedido en OpenAI tras {OPENAI_MAX_REINTENTOS} reintentos. Intenta de nuevo en unos momentos."
+    if isinstance(e, openai.APIError):
+        return f"Error de API de OpenAI: {str(e)}"
+    return f"Error al generar respuesta con OpenAI: {str(e)}"
+
+def sentencia_error(error_msg: str) -> str:
     # Respuesta de error también en formato de sentencia
     fecha_sentencia = generar_fecha_sentencia()
     return f"""
@@ -730,14 +2905,126 @@ Se requiere revisión técnica del sistema antes de proceder con el análisis ju
 NOTIFÍQUESE AL ADMINISTRADOR DEL SISTEMA.
 """
 
+# Función para generar respuestas con OpenAI
+def generar_respuesta_openai(prompt: str, pregunta: str = "", modelo: str = "gpt-3.5-turbo") -> str:
+    """
+    Genera una respuesta usando la API de OpenAI con formato de sentencia
+    Modelos disponibles: gpt-3.5-turbo, gpt-4, gpt-4-turbo-preview
+    """
+    try:
+        respuesta = llamar_openai(prompt, modelo)
+        
+        # Post-procesar para asegurar formato de sentencia
+        return post_procesar_sentencia(respuesta, pregunta)
+    except Exception as e:
+        return sentencia_error(mensaje_error_openai(e))
+
+# === Respuestas con plazo y modelo de respaldo (hedging) ===
+class SolicitudCancelada(Exception):
+    """El cliente se desconectó: se abandona el trabajo pendiente de la solicitud"""
+
+ejecutor_hedging = ThreadPoolExecutor(max_workers=HEDGE_MAX_HILOS, thread_name_prefix="hedge")
+
+def generar_respuesta_con_respaldo(prompt: str, pregunta: str, modelo: str, deadline_s: float = None, cancelacion: threading.Event = None):
+    """
+    Genera la sentencia con el modelo principal dentro de un plazo. Si no responde antes de
+    HEDGE_UMBRAL_S (o falla), lanza la misma petición al modelo de respaldo; gana la primera
+    respuesta válida y la otra conexión se cierra. Si se activa la cancelación (cliente
+    desconectado) se cierran todas las conexiones y se lanza SolicitudCancelada.
+    Devuelve (texto, info_modelo).
+    """
+    deadline_s = deadline_s or DEADLINE_RESPUESTA_S
+    limite = time.monotonic() + deadline_s
+    respaldo = OPENAI_MODELO_RESPALDO if OPENAI_MODELO_RESPALDO and OPENAI_MODELO_RESPALDO != modelo else None
+
+    cancelaciones = {}
+    pendientes = {}
+    errores = {}
+
+    def lanzar(nombre_modelo: str):
+        cancelaciones[nombre_modelo] = threading.Event()
+        restante = max(0.1, limite - time.monotonic())
+        futuro = ejecutor_hedging.submit(llamar_openai, prompt, nombre_modelo, cancelaciones[nombre_modelo], restante)
+        pendientes[futuro] = nombre_modelo
+
+    def cerrar_pendientes():
+        # Cancelar la llamada del perdedor corta su conexión HTTP y libera su hilo
+        for futuro, nombre_modelo in pendientes.items():
+            futuro.cancel()
+            cancelaciones[nombre_modelo].set()
+
+    lanzar(modelo)
+    motivo = "modelo_principal"
+    hedge_lanzado = False
+
+    try:
+        while pendientes:
+            restante = limite - time.monotonic()
+            if restante <= 0:
+                break
+
+            # Esperar al principal solo hasta el umbral de hedging
+            espera = restante
+            if respaldo and not hedge_lanzado:
+                espera = min(restante, max(0.0, HEDGE_UMBRAL_S - (deadline_s - restante)))
+            if cancelacion is not None:
+                espera = min(espera, INTERVALO_CANCELACION_S)
+
+            terminados, _ = wait(list(pendientes), timeout=espera, return_when=FIRST_COMPLETED)
+
+            if cancelacion is not None and cancelacion.is_set():
+                gobernador_openai.incrementar("generaciones_abortadas")
+                raise SolicitudCancelada("Cliente desconectado durante la generación")
+
+            for futuro in terminados:
+                nombre_modelo = pendientes.pop(futuro)
+                try:
+                    respuesta = futuro.result()
+                except Exception as e:
+                    errores[nombre_modelo] = e
+                    print(f"Error en modelo {nombre_modelo}: {str(e)}")
+                    continue
+
+                if nombre_modelo != modelo:
+                    motivo = "respaldo_por_error" if modelo in errores else "respaldo_por_latencia"
+                return post_procesar_sentencia(respuesta, pregunta), {
+                    "modelo_usado": nombre_modelo,
+                    "modelo_principal": modelo,
+                    "motivo_modelo": motivo,
+                    "hedge_lanzado": hedge_lanzado,
+                    "tiempo_respuesta_s": round(deadline_s - (limite - time.monotonic()), 3)
+                }
+
+            # El principal falló o superó el umbral: lanzar el respaldo
+            transcurrido = deadline_s - (limite - time.monotonic())
+            if respaldo and not hedge_lanzado and (modelo in errores or transcurrido >= HEDGE_UMBRAL_S):
+                hedge_lanzado = True
+                lanzar(respaldo)
+    finally:
+        cerrar_pendientes()
+
+    if errores and not pendientes and len(errores) == (2 if hedge_lanzado else 1):
+        ultimo_error = errores.get(respaldo) or errores.get(modelo)
+        error_msg = mensaje_error_openai(ultimo_error)
+        motivo = "error"
+    else:
+        error_msg = f"No se obtuvo respuesta dentro del plazo de {deadline_s:.0f} segundos."
+        motivo = "plazo_excedido"
+
+    return sentencia_error(error_msg), {
+        "modelo_usado": None,
+        "modelo_principal": modelo,
+        "motivo_modelo": motivo,
+        "hedge_lanzado": hedge_lanzado,
+        "tiempo_respuesta_s": round(deadline_s - (limite - time.monotonic()), 3)
+    }
+
 # Configurar modelo de OpenAI
 class ModeloConfig(BaseModel):
     modelo: str
 
 @app.post("/configuracion/modelo", summary="Configurar modelo de OpenAI a usar")
 async def configurar_modelo(config: ModeloConfig):
-    global OPENAI_MODEL
-    
     modelos_disponibles = [
         "gpt-3.5-turbo",
         "gpt-3.5-turbo-16k", 
@@ -755,12 +3042,14 @@ async def configurar_modelo(config: ModeloConfig):
     
     # Verificar que el modelo funciona con una consulta de prueba
     try:
-        test_response = generar_respuesta_openai("Di 'OK' si funcionas", "test", config.modelo)
-        OPENAI_MODEL = config.modelo
+        # En un hilo: la llamada puede esperar en la cola del gobernador sin bloquear el event loop
+        test_response = await asyncio.to_thread(generar_respuesta_openai, "Di 'OK' si funcionas", "test", config.modelo)
+        modelo_anterior = leer_modelo_actual()
+        guardar_estado("openai_model", config.modelo)
         
         return {
             "estado": "ok",
-            "modelo_anterior": OPENAI_MODEL,
+            "modelo_anterior": modelo_anterior,
             "modelo_actual": config.modelo,
             "test_response": test_response,
             "mensaje": f"Modelo cambiado exitosamente a {config.modelo}"
@@ -774,7 +3063,7 @@ async def configurar_modelo(config: ModeloConfig):
 @app.get("/configuracion/modelo", summary="Obtener modelo actual de OpenAI")
 async def obtener_modelo_actual():
     return {
-        "modelo_actual": OPENAI_MODEL,
+        "modelo_actual": leer_modelo_actual(),
         "modelos_disponibles": [
             "gpt-3.5-turbo",
             "gpt-3.5-turbo-16k", 
@@ -0,0 +1,119 @@
+#!/usr/bin/env python3
+"""
+Benchmark de búsqueda: compara el modo "completo" (payload en la búsqueda) con el modo "ids"
+(solo IDs y scores + un retrieve del top final) contra la colección configurada en .env, y la
+búsqueda global con la enrutada por especialidad.
+
+Uso: python benchmark_busqueda.py [repeticiones] [limite]
+"""
+
+import json
+import statistics
+import sys
+import time
+
+import app
+
+PREGUNTAS = [
+    "¿Qué pena establece el COIP para el robo con violencia?",
+    "Sanción por homicidio culposo en accidente de tránsito",
+    "Hurto de mercadería en un local comercial por valor de 350 dólares",
+    "¿Cuándo procede la prisión preventiva?",
+    "Estafa mediante transferencias electrónicas fraudulentas",
+    "Violencia psicológica contra la mujer o miembros del núcleo familiar",
+    "Tráfico ilícito de sustancias catalogadas sujetas a fiscalización",
+    "Derechos de las personas privadas de libertad"
+]
+
+def tamaño_respuesta(puntos) -> int:
+    # Aproximación del tamaño de la respuesta serializada de Qdrant
+    return len(json.dumps([p.model_dump(mode="json") for p in puntos], ensure_ascii=False).encode("utf-8"))
+
+def medir(modo: str, vectores, repeticiones: int, limite: int) -> dict:
+    latencias_busqueda = []
+    latencias_totales = []
+    bytes_busqueda = []
+    bytes_retrieve = []
+
+    for _ in range(repeticiones):
+        for vector in vectores:
+            inicio = time.perf_counter()
+            resultados = app.qdrant_client.search(
+                collection_name=app.COLLECTION_NAME,
+                query_vector=vector,
+                limit=limite,
+                score_threshold=app.MIN_SIMILARITY_THRESHOLD,
+                with_payload=False if modo == "ids" else app.CAMPOS_PAYLOAD_CONTEXTO
+            )
+            fin_busqueda = time.perf_counter()
+            bytes_busqueda.append(tamaño_respuesta(resultados))
+
+            if modo == "ids":
+                app.completar_payloads(resultados)
+                bytes_retrieve.append(tamaño_respuesta(resultados) - bytes_busqueda[-1])
+            fin = time.perf_counter()
+
+            latencias_busqueda.append((fin_busqueda - inicio) * 1000)
+            latencias_totales.append((fin - inicio) * 1000)
+
+    def percentil(valores, p):
+        return round(sorted(valores)[int(len(valores) * p) - 1], 2)
+
+    return {
+        "modo": modo,
+        "busqueda_ms_p50": round(statistics.median(latencias_busqueda), 2),
+        "busqueda_ms_p95": percentil(latencias_busqueda, 0.95),
+        "total_ms_p50": round(statistics.median(latencias_totales), 2),
+        "total_ms_p95": percentil(latencias_totales, 0.95),
+        "bytes_busqueda_promedio": round(statistics.mean(bytes_busqueda)),
+        "bytes_retrieve_promedio": round(statistics.mean(bytes_retrieve)) if bytes_retrieve else 0
+    }
+
+def medir_enrutamiento(vectores, repeticiones: int, limite: int) -> dict:
+    # Misma búsqueda sin filtro y limitada a los shards que elige el enrutador
+    latencias_global = []
+    latencias_enrutada = []
+    rutas = [app.enrutar_pregunta(pregunta) for pregunta in PREGUNTAS]
+
+    for _ in range(repeticiones):
+        for vector, ruta in zip(vectores, rutas):
+            inicio = time.perf_counter()
+            app.buscar_contexto(vector, limite)
+            latencias_global.append((time.perf_counter() - inicio) * 1000)
+
+            inicio = time.perf_counter()
+            app.buscar_contexto(vector, limite, especialidades=ruta["especialidades"])
+            latencias_enrutada.append((time.perf_counter() - inicio) * 1000)
+
+    return {
+        "preguntas_enrutadas": sum(1 for ruta in rutas if ruta["modo"] == "especialidad"),
+        "reduccion_espacio_busqueda_promedio": round(statistics.mean(ruta["reduccion_espacio_busqueda"] for ruta in rutas), 4),
+        "global_ms_p50": round(statistics.median(latencias_global), 2),
+        "enrutada_ms_p50": round(statistics.median(latencias_enrutada), 2)
+    }
+
+def main():
+    repeticiones = int(sys.argv[1]) if len(sys.argv) > 1 else 10
+    limite = int(sys.argv[2]) if len(sys.argv) > 2 else app.SEARCH_LIMIT
+
+    vectores = app.model_embeddings.encode(PREGUNTAS)
+    print(f"📊 Benchmark de búsqueda: {len(PREGUNTAS)} preguntas x {repeticiones} repeticiones, límite {limite}\n")
+
+    resultados = [medir(modo, vectores, repeticiones, limite) for modo in ("completo", "ids")]
+    for resultado in resultados:
+        print(json.dumps(resultado, ensure_ascii=False))
+
+    completo, ids = resultados
+    if completo["bytes_busqueda_promedio"]:
+        reduccion = 100 * (1 - ids["bytes_busqueda_promedio"] / completo["bytes_busqueda_promedio"])
+        print(f"\n✅ Reducción del tamaño de la respuesta de búsqueda: {reduccion:.1f}%")
+    print(f"⏱️  Búsqueda p50: {completo['busqueda_ms_p50']} ms (completo) vs {ids['busqueda_ms_p50']} ms (ids)")
+    print(f"⏱️  Total p50 (con retrieve): {completo['total_ms_p50']} ms (completo) vs {ids['total_ms_p50']} ms (ids)")
+
+    enrutamiento = medir_enrutamiento(vectores, repeticiones, limite)
+    print(f"\n🧭 Enrutamiento: {enrutamiento['preguntas_enrutadas']}/{len(PREGUNTAS)} preguntas a su especialidad, "
+          f"reducción del espacio de búsqueda {100 * enrutamiento['reduccion_espacio_busqueda_promedio']:.1f}%")
+    print(f"⏱️  Búsqueda p50: {enrutamiento['global_ms_p50']} ms (global) vs {enrutamiento['enrutada_ms_p50']} ms (enrutada)")
+
+if __name__ == "__main__":
+    main()
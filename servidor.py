@@ -0,0 +1,27 @@
+#!/usr/bin/env python3
+"""
+Punto de entrada para producción: varios workers de uvicorn, sin recarga automática.
+El documento actual y el modelo configurado se comparten entre los workers de este host vía ESTADO_DB_PATH.
+"""
+
+import os
+
+import uvicorn
+
+def main():
+    host = os.getenv("HOST", "0.0.0.0")
+    port = int(os.getenv("PORT", "8000"))
+    workers = int(os.getenv("WEB_CONCURRENCY", str(os.cpu_count() or 1)))
+
+    print(f"🚀 Iniciando Chatbot Leyes en {host}:{port} con {workers} workers")
+    uvicorn.run(
+        "app:app",
+        host=host,
+        port=port,
+        workers=workers,
+        reload=False,
+        proxy_headers=True
+    )
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,83 @@
+#!/usr/bin/env python3
+"""
+Verificación de la cancelación de llamadas a OpenAI: levanta un servidor simulado que tarda
+en responder, cancela la llamada a mitad de camino y comprueba que el hilo queda libre de
+inmediato y que el servidor ve cerrarse la conexión (no llega a escribir la respuesta).
+
+Uso: python verificar_cancelacion_openai.py [espera_servidor_s] [cancelar_tras_s]
+"""
+
+import json
+import select
+import socket
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import app
+
+RESPUESTA = {
+    "id": "chatcmpl-simulado",
+    "object": "chat.completion",
+    "created": 0,
+    "model": "simulado",
+    "choices": [{"index": 0, "message": {"role": "assistant", "content": "respuesta simulada"}, "finish_reason": "stop"}],
+    "usage": {"prompt_tokens": 1, "completion_tokens": 1, "total_tokens": 2}
+}
+
+def crear_servidor(espera_s: float, registro: dict):
+    class Manejador(BaseHTTPRequestHandler):
+        def do_POST(self):
+            self.rfile.read(int(self.headers.get("Content-Length", 0)))
+            limite = time.monotonic() + espera_s
+            while time.monotonic() < limite:
+                # Conexión cerrada por el cliente: el socket queda legible con EOF
+                legibles, _, _ = select.select([self.connection], [], [], 0.05)
+                if legibles and self.connection.recv(1, socket.MSG_PEEK) == b"":
+                    registro["conexion_cerrada_s"] = round(time.monotonic() - (limite - espera_s), 3)
+                    return
+            cuerpo = json.dumps(RESPUESTA).encode("utf-8")
+            self.send_response(200)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(cuerpo)))
+            self.end_headers()
+            self.wfile.write(cuerpo)
+            registro["respuesta_completa"] = True
+
+        def log_message(self, *args):
+            pass
+
+    return ThreadingHTTPServer(("127.0.0.1", 0), Manejador)
+
+def main():
+    espera_s = float(sys.argv[1]) if len(sys.argv) > 1 else 4.0
+    cancelar_tras_s = float(sys.argv[2]) if len(sys.argv) > 2 else 0.5
+
+    registro = {"respuesta_completa": False, "conexion_cerrada_s": None}
+    servidor = crear_servidor(espera_s, registro)
+    threading.Thread(target=servidor.serve_forever, daemon=True).start()
+    app.OPENAI_BASE_URL = f"http://127.0.0.1:{servidor.server_port}/v1"
+
+    print(f"🧪 Servidor simulado: responde en {espera_s:.1f} s; se cancela a los {cancelar_tras_s:.1f} s\n")
+    cancelacion = threading.Event()
+    threading.Timer(cancelar_tras_s, cancelacion.set).start()
+    inicio = time.monotonic()
+    try:
+        app.llamar_openai("Prueba de cancelación", "gpt-4o-mini", cancelacion)
+        resultado = "completada"
+    except app.LlamadaAbandonada:
+        resultado = "abandonada"
+    hilo_libre_s = time.monotonic() - inicio
+
+    time.sleep(min(1.0, espera_s))
+    servidor.shutdown()
+
+    print(f"Llamada: {resultado}, hilo libre a los {hilo_libre_s:.2f} s")
+    print(f"Servidor: conexión cerrada a los {registro['conexion_cerrada_s']} s, respuesta completa: {registro['respuesta_completa']}")
+    correcto = resultado == "abandonada" and hilo_libre_s < espera_s and not registro["respuesta_completa"]
+    print("\n✅ La cancelación corta la petición en curso" if correcto else "\n❌ La petición siguió en curso tras cancelar")
+    sys.exit(0 if correcto else 1)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,40 @@
+#!/usr/bin/env python3
+"""
+Casos de verificación del detector de citas de artículos en preguntas (extraer_citas_articulos).
+
+Uso: python verificar_citas_articulos.py
+"""
+
+import sys
+
+import app
+
+CASOS = [
+    ("art 140", ["140"]),
+    ("art. 140", ["140"]),
+    ("artículo 140 y 141", ["140", "141"]),
+    ("arts 196 y 197 del COIP", ["196", "197"]),
+    ("arts. 196 y 197", ["196", "197"]),
+    ("artículos 140, 141 y 142 del COIP", ["140", "141", "142"]),
+    ("¿qué dicen los arts. 140 y 141 COIP?", ["140", "141"]),
+    ("artículos 1 y 2 Código Civil", ["1", "2"]),
+    ("arts. 10 y 11 de la Constitución", ["10", "11"]),
+    ("Art. 140 e art. 141, ¿qué dicen?", ["140", "141"]),
+    ("art. 189 y art 190", ["189", "190"]),
+    ("el artículo 140 y 5 personas", ["140"]),
+    ("según el art. 45, 3 personas", ["45"]),
+    ("arte 5", []),
+]
+
+def main():
+    fallos = 0
+    for pregunta, esperado in CASOS:
+        obtenido = app.extraer_citas_articulos(pregunta)
+        correcto = obtenido == esperado
+        fallos += not correcto
+        print(f"{'✅' if correcto else '❌'} {pregunta!r} -> {obtenido}" + ("" if correcto else f" (esperado {esperado})"))
+    print(f"\n{len(CASOS) - fallos}/{len(CASOS)} casos correctos")
+    sys.exit(1 if fallos else 0)
+
+if __name__ == "__main__":
+    main()